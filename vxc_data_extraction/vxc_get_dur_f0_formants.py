@@ -1,6 +1,6 @@
 import pandas as pd
 pd.options.mode.copy_on_write = True
-import os, logging, argparse, time
+import os, json, logging, argparse, time
 from praatio import textgrid
 import parselmouth as psm
 import numpy as np
@@ -147,9 +147,39 @@ def parse_args():
     parser.add_argument("lang_code", type=str, help="Language code")
     parser.add_argument("ver_num", type=str, help="Version number")
     parser.add_argument("output_dir", type=str, help="Directory to save the output CSV file")
+    parser.add_argument("--previous_ver", type=str, default=None,
+                        help="Previous version number: keep its results for the clips that did not change (release_delta.tsv) and only process the others")
     return parser.parse_args()
 
-def main(commonvoice_dir, lang_code, ver_num, output_dir):
+# Lexicon and acoustic model hashes of the alignments of a release (alignment_stamp.json, written by vxc_pipeline/vxc_delta.py)
+def read_alignment_stamp(lang_dir):
+    stamp_path = os.path.join(lang_dir, 'alignment_stamp.json')
+    if not os.path.exists(stamp_path):
+        return None
+    with open(stamp_path) as f:
+        return json.load(f)
+
+# Results of the previous release for the clips that did not change, and the TextGrids of the clips that need processing.
+# The delta (release_delta.tsv in the language folder) is made by vxc_pipeline/vxc_delta.py.
+# Nothing is kept if the two releases were aligned with different lexicons or acoustic models.
+def previous_results(lang_dir, lang_code, previous_ver, output_dir, tg_files):
+    previous_csv = os.path.join(output_dir, f'{lang_code}_v{previous_ver}_results.csv')
+    delta = pd.read_csv(os.path.join(lang_dir, 'release_delta.tsv'), sep='\t', dtype='str')
+    unchanged = set(delta.loc[delta['status'] == 'unchanged', 'path'].map(lambda path: os.path.splitext(path)[0]))
+
+    previous_stamp = read_alignment_stamp(os.path.join(os.path.dirname(os.path.normpath(lang_dir)), f'{lang_code}_v{previous_ver}'))
+    stamp = read_alignment_stamp(lang_dir)
+    if previous_stamp is not None and stamp is not None and previous_stamp != stamp:
+        print(f"The v{previous_ver} alignments were made with another lexicon or acoustic model: all TextGrids are processed.")
+        unchanged = set()
+
+    previous = pd.read_csv(previous_csv, dtype={'file_id': 'str'}, keep_default_na=False)
+    previous = previous[previous['file_id'].isin(unchanged)]
+    tg_files = [tg_file for tg_file in tg_files if os.path.splitext(tg_file)[0] not in unchanged]
+    print(f"Results of {previous['file_id'].nunique()} unchanged clips kept from {previous_csv}; {len(tg_files)} TextGrids to process.")
+    return previous, tg_files
+
+def main(commonvoice_dir, lang_code, ver_num, output_dir, previous_ver=None):
     # Record the start time
     start_time = time.time()
 
@@ -163,12 +193,17 @@ def main(commonvoice_dir, lang_code, ver_num, output_dir):
     total_failed_intervals = 0
     total_processed_intervals = 0
 
+    tg_files = [tg_file.name for tg_file in os.scandir(tg_dir) if tg_file.is_file() and tg_file.name.endswith('.TextGrid')]
+    previous = None
+    if previous_ver is not None:
+        previous, tg_files = previous_results(lang_dir, lang_code, previous_ver, output_dir, tg_files)
+
     # Using ProcessPoolExecutor for parallel processing
     max_workers = min(10, os.cpu_count() or 1)  # Adapt according to your CPU
     with ProcessPoolExecutor(max_workers=max_workers) as executor:
         futures = {
-            executor.submit(process_textgrid_file, lang_code, tg_file.name, tg_dir, snd_dir): tg_file.name
-            for tg_file in os.scandir(tg_dir) if tg_file.is_file() and tg_file.name.endswith('.TextGrid')
+            executor.submit(process_textgrid_file, lang_code, tg_file, tg_dir, snd_dir): tg_file
+            for tg_file in tg_files
         }
 
         for future in as_completed(futures):
@@ -184,6 +219,8 @@ def main(commonvoice_dir, lang_code, ver_num, output_dir):
     # Save results to CSV
     df = pd.DataFrame(results, columns=['lang_code', 'file_id', 'prev_seg', 'seg', 'seg_intv', 'next_seg', 'seg_dur', 'F0', 'F1', 'F2',
                                         'word', 'word_dur', 'utt_dur', 'n_phone', 'utt_pos'])
+    if previous is not None:
+        df = pd.concat([previous, df], ignore_index=True)
     if not df.empty:
         df.to_csv(output_csv, index=False)
         print(f"Results saved to {output_csv}")
@@ -206,4 +243,4 @@ def main(commonvoice_dir, lang_code, ver_num, output_dir):
 
 if __name__ == "__main__":
     args = parse_args()
-    main(args.commonvoice_dir, args.lang_code, args.ver_num, args.output_dir)
+    main(args.commonvoice_dir, args.lang_code, args.ver_num, args.output_dir, args.previous_ver)
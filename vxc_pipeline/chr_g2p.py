@@ -1,30 +1,43 @@
-import argparse, re, itertools
-
-# Multithreading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-# Load the pretrained model
-from transformers import T5ForConditionalGeneration, AutoTokenizer
-model = T5ForConditionalGeneration.from_pretrained('charsiu/g2p_multilingual_byT5_tiny_16_layers_100')
-tokenizer = AutoTokenizer.from_pretrained('google/byt5-small')
-
-# Tokenize IPA
-from lingpy import ipa2tokens
-
-# Define all IPA plus white space
-ipa_symbols = re.compile(r'[\u0020-\u007E\u00A0-\u00FF\u0100-\u017F\u0180-\u024F\u0250-\u02AF\u02B0-\u02FF\u0300-\u036F\u0370-\u03FF\u1AB0-\u1AFF\u1DC0-\u1DFF\u2000-\u206F\u2070-\u209F\u2190-\u21FF\u2C60-\u2C7F\uA700-\uA71F]+|\s')
+import argparse, re, itertools, os, random, threading
+
+# The pretrained model is loaded (and downloaded if needed) on first use, not when this module is imported
+model_name = 'charsiu/g2p_multilingual_byT5_tiny_16_layers_100'
+tokenizer_name = 'google/byt5-small'
+model = None
+tokenizer = None
+model_lock = threading.Lock()
+
+def load_model():
+    global model, tokenizer
+    with model_lock:
+        if model is None:
+            from transformers import T5ForConditionalGeneration, AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+            model = T5ForConditionalGeneration.from_pretrained(model_name)
+    return model, tokenizer
+
+# Tokenize and sanitize IPA (same output as lingpy's ipa2tokens, memoized)
+from vxc_ipa import segment_ipa, clean_ipa, sanitize_ipa, ipa_version
+
+# Cross-release G2P cache
+from vxc_lexicon_cache import LexiconCache, cache_lookup, cache_store, g2p_version, package_version, cache_path
+from vxc_g2p_backends import G2PBackend
 
 ########################################################################################################################
 ########################################################################################################################
 
 # Charsiu
-def chr_generate(wordlist, code_chr):
+def chr_generate(wordlist, code_chr, g2p_model=None):
+        # Use the pretrained model unless another one (e.g. its quantized version) is given
+        pretrained_model, tokenizer = load_model()
+        g2p_model = pretrained_model if g2p_model is None else g2p_model
         chr_words = [f'<{code_chr}>: '+i for i in wordlist]
         out = tokenizer(chr_words, padding=True, add_special_tokens=False, return_tensors='pt')
-        preds = model.generate(**out, num_beams=1, max_length=50)
+        preds = g2p_model.generate(**out, num_beams=1, max_length=50)
         phones = tokenizer.batch_decode(preds.tolist(), skip_special_tokens=True)
         
-        phones = [' '.join(ipa2tokens(phone)) for phone in phones if phone.strip() != '']
+        # Empty predictions are kept as '' so that the phones stay aligned with the words
+        phones = [segment_ipa(phone) if phone.strip() != '' else '' for phone in phones]
         phones = [re.sub(':', 'ː', phone) for phone in phones]
         phones = [re.sub('ː([aɐɑæɶeɛəɜɞiɪyɨʉøɵœoɔuʊɯɤʌ]ː)', 'ː \1', phone) for phone in phones]
         return phones
@@ -33,12 +46,8 @@ def chr_postproc(phones, code_chr):
     # Separate identical IPAs
     phones = [re.sub(r'([\u0020-\u007E\u00A0-\u00FF\u0100-\u017F\u0180-\u024F\u0250-\u02AF\u02B0-\u02FF\u0300-\u036F\u0370-\u03FF])\1', r'\1 \1', phone) for phone in phones]
 
-    only_ipa = [re.findall(ipa_symbols, phone) for phone in phones]
-    phones = [' '.join(phone) for phone in only_ipa]
-    # Strip away the tone stress markers
-    phones = [re.sub(r'[˥˦˧˨˩]+|ˈ|ˌ', '', phone) for phone in phones]
-    # Get rid of extra white spaces
-    phones = [re.sub(r'\s+', ' ', phone) for phone in phones]
+    # Get rid of the non-IPAs and strip away the tone and stress markers and extra white spaces
+    phones, _ = sanitize_ipa(phones, remove='˥˦˧˨˩ˈˌ', collapse_spaces=True)
     
     return phones
 
@@ -47,19 +56,152 @@ def charsiu_g2p(words, code_chr):
     phones = chr_postproc(phones, code_chr)
     return phones
  
-def charsiu_g2p_parallel(words, code_chr):
-    with ThreadPoolExecutor(8) as executor:
-        futures = [executor.submit(charsiu_g2p, [word], code_chr) for word in words]
-        phones_list = [future.result() for future in as_completed(futures)]
-    phones_list = [(word, phone) for word, phones in zip(words, phones_list) for phone in phones]
-    
+# Group the words into batches of similar lengths, so that little padding is needed,
+# with at most token_budget (padded) input tokens per batch. ByT5 tokens are bytes.
+def chr_batches(words, code_chr, token_budget):
+    prefix_len = len(f'<{code_chr}>: '.encode('utf8'))
+    batches = []
+    batch = []
+    for word in sorted(words, key=lambda word: (len(word.encode('utf8')), word)):
+        # The words are sorted by length, so the current word is the longest of the batch
+        n_tokens = prefix_len + len(word.encode('utf8'))
+        if len(batch) > 0 and (len(batch) + 1) * n_tokens > token_budget:
+            batches.append(batch)
+            batch = []
+        batch.append(word)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+# Everything that can change the Charsiu lexicon (for the G2P cache)
+def chr_version(precision='fp32'):
+    return g2p_version(model_name, tokenizer_name, precision, package_version('transformers'), ipa_version(), chr_generate, chr_postproc)
+
+# Convert a batch of words: returns (word, phone) pairs, leaving out the words without a prediction
+def chr_convert(batch, code_chr, g2p_model=None):
+    phones = chr_generate(batch, code_chr, g2p_model)
+    clean_phones = chr_postproc(phones, code_chr)
+    return [(word, clean_phone) for word, phone, clean_phone in zip(batch, phones, clean_phones) if phone != '']
+
+def charsiu_g2p_batched(words, code_chr, token_budget=4096, g2p_model=None):
+    # Each word type is converted once
+    unique_words = set(words)
+    phones_dict = {}
+    for batch in chr_batches(unique_words, code_chr, token_budget):
+        phones_dict.update(chr_convert(batch, code_chr, g2p_model))
+
+    # Put the results back in the order of the input
+    phones_list = [(word, phones_dict[word]) for word in words if word in phones_dict]
+
     return phones_list
 
+# The model is shared by all the threads of the process, and torch releases the GIL while it runs,
+# so Charsiu is run on threads rather than on processes that would each load the model again
+class CharsiuBackend(G2PBackend):
+    engine = 'chr'
+    thread_safe = True
+    picklable = False
+    load_cost = 20.0
+    word_cost = 5e-3
+    batch_size = 4096
+
+    def __init__(self, code_chr, token_budget=4096):
+        super().__init__(code_chr)
+        self.token_budget = token_budget
+
+    def load(self):
+        self.loaded = load_model()
+
+    def version(self):
+        return chr_version()
+
+    def convert(self, words):
+        return charsiu_g2p_batched(words, self.lang, self.token_budget)
+
+# Same as charsiu_g2p_batched, but each batch is appended to the lexicon file as soon as it is converted,
+# and its words to a checkpoint index (dict_file_path + '.ckpt'). If the index exists, the run resumes:
+# the words it lists are not converted again and their pronunciations are read back from the lexicon file.
+# The first line of the index is the G2P version (chr_version(precision)) and the language code of the run:
+# an index made with another model, precision or language code is discarded, with the lexicon file.
+# The lexicon file is left in batch order; main rewrites it in input order and removes the index at the end.
+def charsiu_g2p_resumable(words, code_chr, dict_file_path, version, token_budget=4096, g2p_model=None):
+    ckpt_path = dict_file_path + '.ckpt'
+    header = f'{version}\t{code_chr}\n'
+    phones_dict = {}
+    done = set()
+    if os.path.exists(ckpt_path):
+        with open(ckpt_path, 'r') as ckpt:
+            same_run = ckpt.readline() == header
+            done = set(line.rstrip('\n') for line in ckpt) if same_run else set()
+        if not same_run:
+            print(f'Discarding {ckpt_path}: it was made with another model, precision or language code.')
+            os.remove(ckpt_path)
+    if os.path.exists(ckpt_path):
+        if os.path.exists(dict_file_path):
+            # A line cut short by a crash is dropped: the file is truncated after its last complete line,
+            # so that the next batch does not get appended to it
+            with open(dict_file_path, 'rb+') as dict_file:
+                dict_file.truncate(dict_file.read().rfind(b'\n') + 1)
+            with open(dict_file_path, 'r') as dict_file:
+                for line in dict_file:
+                    fields = line.rstrip('\n').split('\t', 1)
+                    # Lines of a batch that was not checkpointed are converted again
+                    if len(fields) == 2 and fields[0] in done:
+                        phones_dict[fields[0]] = fields[1]
+        print(f'Resuming from {ckpt_path}: {len(done)} words already converted.')
+    elif os.path.exists(dict_file_path):
+        os.remove(dict_file_path)
+
+    todo = set(words) - done
+    batches = chr_batches(todo, code_chr, token_budget)
+    new_ckpt = not os.path.exists(ckpt_path)
+    with open(dict_file_path, 'a') as dict_file, open(ckpt_path, 'a') as ckpt:
+        if new_ckpt:
+            ckpt.write(header)
+            ckpt.flush()
+        for i, batch in enumerate(batches):
+            pairs = chr_convert(batch, code_chr, g2p_model)
+            dict_file.writelines(f"{word}\t{phone}\n" for word, phone in pairs)
+            dict_file.flush()
+            # The lexicon lines are written before the batch is marked as done
+            ckpt.writelines(word + '\n' for word in batch)
+            ckpt.flush()
+            phones_dict.update(pairs)
+            print(f'Batch {i+1}/{len(batches)} done ({len(batch)} words).')
+
+    return [(word, phones_dict[word]) for word in words if word in phones_dict]
+
+# CPU inference profile: int8 dynamic quantization of the linear layers of the model.
+# The quantized model is checked against the full-precision one on a sample of the words,
+# and is only used if their outputs agree on at least min_agreement of the sample.
+def quantize_model(words, code_chr, n_sample=200, min_agreement=0.98, token_budget=4096):
+    import torch
+    q_model = torch.quantization.quantize_dynamic(load_model()[0], {torch.nn.Linear}, dtype=torch.qint8)
+
+    sample = random.Random(0).sample(sorted(set(words)), min(n_sample, len(set(words))))
+    fp32 = dict(charsiu_g2p_batched(sample, code_chr, token_budget))
+    int8 = dict(charsiu_g2p_batched(sample, code_chr, token_budget, q_model))
+    n_agree = sum(fp32.get(word) == int8.get(word) for word in sample)
+    agreement = n_agree / len(sample) if len(sample) > 0 else 1
+    print(f'int8 and fp32 outputs agree on {n_agree} of {len(sample)} sampled words ({agreement:.1%}).')
+
+    if agreement < min_agreement:
+        print(f'Agreement is below {min_agreement:.1%}: using the full-precision model.')
+        return None
+    return q_model
+
 def main():
     parser = argparse.ArgumentParser(description='Perform Charsiu g2p conversion with post-processing')
     parser.add_argument('word_file', type=str, help='Input word file')
     parser.add_argument('code_chr', type=str, help='Code for processing')
     parser.add_argument('dict_file_path', type=str, help='Path to the output dictionary file')
+    parser.add_argument('--cache', nargs='?', const=cache_path, default=None, help='Reuse the pronunciations of words converted before from this G2P cache')
+    parser.add_argument('--token_budget', type=int, default=4096, help='Maximum number of (padded) input tokens per batch')
+    # CPU inference profile
+    parser.add_argument('--threads', type=int, default=None, help='Number of intra-op threads used by torch on CPU')
+    parser.add_argument('--int8', action='store_true', help='Use int8 dynamic quantization of the linear layers (checked against fp32 on a sample)')
+    parser.add_argument('--check_sample', type=int, default=200, help='Number of words to compare int8 and fp32 outputs on')
+    parser.add_argument('--min_agreement', type=float, default=0.98, help='Minimum int8/fp32 agreement on the sample to use int8')
     args = parser.parse_args()
 
     word_file = args.word_file
@@ -70,11 +212,34 @@ def main():
         lines = file.readlines()
         words = [line.strip() for line in lines]
 
-    phones_list = charsiu_g2p_parallel(words, code_chr)
-
+    if args.threads is not None:
+        import torch
+        torch.set_num_threads(args.threads)
+
+    # Only the words that are not in the G2P cache (if any) are converted, and the run can be resumed if it stops
+    cache = LexiconCache(args.cache) if args.cache is not None else None
+    precision = 'int8' if args.int8 else 'fp32'
+    lex_dict, new_words = cache_lookup(words, 'chr', chr_version(precision), code_chr, cache)
+    # The quantized model is only built and checked if there are words to convert;
+    # if it is not used, the words are looked up again under the full-precision version
+    g2p_model = None
+    if args.int8 and len(new_words) > 0:
+        g2p_model = quantize_model(new_words, code_chr, args.check_sample, args.min_agreement, args.token_budget)
+        if g2p_model is None:
+            precision = 'fp32'
+            lex_dict, new_words = cache_lookup(words, 'chr', chr_version(precision), code_chr, cache)
+    version = chr_version(precision)
+    pairs = charsiu_g2p_resumable(new_words, code_chr, dict_file_path, version, args.token_budget, g2p_model) if len(new_words) > 0 else []
+    cache_store(lex_dict, new_words, pairs, 'chr', version, code_chr, cache)
+
+    # Rewrite the lexicon in the order of the word list
     with open(dict_file_path, 'w') as dict_file:
-        for word, phone in phones_list:
-            dict_file.write(f"{word}\t{phone}\n")
+        for word in words:
+            phone = lex_dict[word]
+            if phone is not None:
+                dict_file.write(f"{word}\t{phone}\n")
+    if os.path.exists(dict_file_path + '.ckpt'):
+        os.remove(dict_file_path + '.ckpt')
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,159 @@
+import argparse, os, sys, shutil, subprocess, time, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from vxc_lexicon_cache import LexiconCache, cached_g2p, g2p_version, package_version, file_hash, cache_path
+from vxc_g2p_backends import G2PBackend
+
+# Split a large word list into chunks (32000 words each by default) and convert them with the MFA G2P model.
+# The chunks are converted concurrently by separate `mfa g2p` processes and the outputs are merged in the order of the word list.
+# This replaces mfa_g2p.sh, which split the list one line at a time and ran the chunks one after another.
+
+##########################################################################################################
+##########################################################################################################
+
+# Write the words into chunk files in one pass; returns the chunk file paths
+def split_words(words, split_dir, base_name, chunk_size=32000):
+    os.makedirs(split_dir, exist_ok=True)
+    chunk_paths = []
+    for i in range(0, len(words), chunk_size):
+        chunk_path = os.path.join(split_dir, f'{base_name}_{i // chunk_size + 1:02d}.txt')
+        with open(chunk_path, 'w') as chunk_file:
+            chunk_file.writelines(word + '\n' for word in words[i:i + chunk_size])
+        chunk_paths.append(chunk_path)
+    return chunk_paths
+
+# Run `mfa g2p` on one chunk; returns (chunk path, output path, seconds, error message or None)
+def run_chunk(chunk_path, g2p_model_path, mfa_args=()):
+    out_path = chunk_path[:-len('.txt')] + '_g2p.txt'
+    start = time.time()
+    proc = subprocess.run(['mfa', 'g2p', chunk_path, g2p_model_path, out_path] + list(mfa_args),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    duration = time.time() - start
+    if proc.returncode != 0 or not os.path.exists(out_path):
+        error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f'exit code {proc.returncode}'
+        return chunk_path, out_path, duration, error
+    return chunk_path, out_path, duration, None
+
+# Convert the chunks with at most n_jobs `mfa g2p` processes at a time.
+# Failed chunks are run again on their own, up to `retries` more times.
+# Returns the output paths in the order of the chunks; raises RuntimeError if a chunk still fails.
+def run_chunks(chunk_paths, g2p_model_path, n_jobs=4, retries=2, mfa_args=()):
+    out_paths = {}
+    todo = list(chunk_paths)
+    for attempt in range(retries + 1):
+        failed = []
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            for chunk_path, out_path, duration, error in executor.map(lambda path: run_chunk(path, g2p_model_path, mfa_args), todo):
+                name = os.path.basename(chunk_path)
+                if error is None:
+                    print(f'{name}: done in {duration:.1f} seconds.')
+                    out_paths[chunk_path] = out_path
+                else:
+                    print(f'{name}: failed after {duration:.1f} seconds (attempt {attempt + 1}): {error}')
+                    failed.append(chunk_path)
+        if len(failed) == 0:
+            break
+        todo = failed
+    else:
+        raise RuntimeError('MFA G2P failed on: ' + ', '.join(os.path.basename(path) for path in todo))
+
+    return [out_paths[path] for path in chunk_paths]
+
+# Read the (word, pronunciation) pairs of MFA G2P outputs
+def read_g2p_outputs(out_paths):
+    pairs = []
+    for out_path in out_paths:
+        with open(out_path, 'r') as out_file:
+            for line in out_file:
+                line = line.rstrip('\n')
+                if '\t' in line:
+                    word, phone = line.split('\t', 1)
+                    pairs.append((word, phone))
+    return pairs
+
+# G2P with MFA on a list of words; returns (word, pronunciation) pairs
+def mfa_g2p(words, g2p_model_path, split_dir, base_name, chunk_size=32000, n_jobs=4, retries=2, mfa_args=()):
+    chunk_paths = split_words(words, split_dir, base_name, chunk_size)
+    print(f'{len(words)} words split into {len(chunk_paths)} chunks, converting with up to {n_jobs} jobs.')
+    out_paths = run_chunks(chunk_paths, g2p_model_path, n_jobs, retries, mfa_args)
+    pairs = read_g2p_outputs(out_paths)
+    # The split files are only deleted if all the chunks went through, so a failed run can be inspected
+    shutil.rmtree(split_dir)
+    return pairs
+
+# Everything that can change the MFA lexicon (for the G2P cache)
+def mfa_version(g2p_model_path, mfa_args=()):
+    return g2p_version(file_hash(g2p_model_path), package_version('montreal-forced-aligner'), list(mfa_args), read_g2p_outputs)
+
+# Each batch is one `mfa g2p` process, so the batches are run on threads; lang is the name of the model file
+class MFABackend(G2PBackend):
+    engine = 'mfa'
+    thread_safe = True
+    load_cost = 0.0
+    word_cost = 2e-3
+    batch_size = 32000
+
+    def __init__(self, g2p_model_path, retries=2, mfa_args=()):
+        super().__init__(os.path.splitext(os.path.basename(g2p_model_path))[0])
+        self.g2p_model_path = g2p_model_path
+        self.retries = retries
+        self.mfa_args = list(mfa_args)
+
+    def version(self):
+        return mfa_version(self.g2p_model_path, self.mfa_args)
+
+    def convert(self, words):
+        split_dir = tempfile.mkdtemp(prefix=f'{self.lang}_g2p_')
+        return mfa_g2p(words, self.g2p_model_path, split_dir, self.lang, self.batch_size, 1, self.retries, self.mfa_args)
+
+##########################################################################################################
+##########################################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Chunked and parallel G2P with an MFA G2P model')
+    parser.add_argument('word_file', help='word list, one word per line')
+    parser.add_argument('g2p_model_path', help='path of the MFA G2P model (.zip)')
+    parser.add_argument('dict_file_path', nargs='?', default=None, help="output lexicon (default: the word list name with 'wordlist' replaced by 'lexicon')")
+    parser.add_argument('--chunk_size', type=int, default=32000, help='number of words per chunk')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='maximum number of mfa g2p processes running at the same time')
+    parser.add_argument('--retries', type=int, default=2, help='number of times a failed chunk is run again')
+    parser.add_argument('--cache', nargs='?', const=cache_path, default=None, help='use the G2P lexicon cache (optionally at the given path)')
+    parser.add_argument('--mfa_args', nargs=argparse.REMAINDER, default=[], help='extra arguments passed on to mfa g2p')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.word_file):
+        sys.exit(f'File not found: {args.word_file}')
+    if not os.path.isfile(args.g2p_model_path):
+        sys.exit(f'G2P model file not found: {args.g2p_model_path}')
+
+    start_time = time.time()
+    input_dir = os.path.dirname(args.word_file)
+    base_name = os.path.splitext(os.path.basename(args.word_file))[0].replace('wordlist', 'lexicon')
+    dict_file_path = args.dict_file_path or os.path.join(input_dir, base_name + '.txt')
+    split_dir = os.path.join(input_dir, base_name + '_split')
+
+    with open(args.word_file, 'r') as word_file:
+        words = [line.rstrip('\n') for line in word_file if line.strip() != '']
+
+    # Only the words that are not in the G2P cache (if any) are converted
+    cache = LexiconCache(args.cache) if args.cache is not None else None
+    lang = os.path.splitext(os.path.basename(args.g2p_model_path))[0]
+    try:
+        lex_dict = cached_g2p(words, lambda new_words: mfa_g2p(new_words, args.g2p_model_path, split_dir, base_name,
+                                                                args.chunk_size, args.jobs, args.retries, args.mfa_args),
+                              'mfa', mfa_version(args.g2p_model_path, args.mfa_args), lang, cache)
+    except RuntimeError as e:
+        sys.exit(f'{e}\nThe split files are kept in {split_dir}.')
+
+    with open(dict_file_path, 'w') as dict_file:
+        for word in words:
+            phone = lex_dict[word]
+            if phone is not None:
+                dict_file.write(f"{word}\t{phone}\n")
+
+    print('')
+    print(f'G2P conversion done, check the results in: {dict_file_path}.')
+    print(f'Total run time: {time.time() - start_time:.0f} seconds.')
+    print('')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import argparse, os, sys, json, subprocess, tempfile, statistics
+
+# Startup-time benchmark
+# Times `import <module>` (and optionally a first call that loads the tools of one language) in fresh Python processes,
+# and reports the median wall time, the peak memory and the number of modules loaded.
+# With --baseline, the same is measured on the pipeline code of an earlier git revision, for comparison.
+#
+#   python startup_benchmark.py vxc_processing_cjk chr_g2p --baseline HEAD~1
+#   python startup_benchmark.py vxc_processing_cjk --setup "import pandas as pd" --call "tok_cjk(pd.DataFrame({'sentence': ['สวัสดีครับ']}), 'th')"
+
+pipeline_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Code run in the child process: it prints its measurements as JSON on the last line
+child_code = '''
+import time, sys, json, resource
+start = time.perf_counter()
+from {module} import *
+import_time = time.perf_counter() - start
+{setup}
+start = time.perf_counter()
+{call}
+call_time = time.perf_counter() - start
+print(json.dumps({{'import': import_time, 'call': call_time, 'modules': len(sys.modules),
+                  'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+'''
+
+def time_startup(module, code_dir, setup='', call='pass', repeat=5):
+    code = child_code.format(module=module, setup=setup, call=call)
+    runs = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-c', code], cwd=code_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if proc.returncode != 0:
+            error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f'exit code {proc.returncode}'
+            return {'error': error}
+        runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    return {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+# Write the pipeline code of a git revision to a temporary directory
+def checkout_revision(revision):
+    tmp_dir = tempfile.mkdtemp(prefix='vxc_baseline_')
+    repo_dir = subprocess.run(['git', 'rev-parse', '--show-toplevel'], cwd=pipeline_dir, stdout=subprocess.PIPE, text=True, check=True).stdout.strip()
+    prefix = os.path.relpath(pipeline_dir, repo_dir)
+    files = subprocess.run(['git', 'ls-tree', '--name-only', revision, prefix + '/'], cwd=repo_dir, stdout=subprocess.PIPE, text=True, check=True).stdout.split()
+    for path in files:
+        if path.endswith('.py'):
+            content = subprocess.run(['git', 'show', f'{revision}:{path}'], cwd=repo_dir, stdout=subprocess.PIPE, check=True).stdout
+            with open(os.path.join(tmp_dir, os.path.basename(path)), 'wb') as f:
+                f.write(content)
+    return tmp_dir
+
+def report(label, result):
+    if 'error' in result:
+        print(f'{label:<24}failed: {result["error"]}')
+    else:
+        print(f'{label:<24}import {result["import"]:7.2f} s   first call {result["call"]:7.2f} s   '
+              f'{result["modules"]:6.0f} modules   peak memory {result["maxrss_mb"]:7.0f} MB')
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import time of pipeline modules in fresh processes')
+    parser.add_argument('modules', nargs='+', help='modules to import, e.g. vxc_processing_cjk chr_g2p')
+    parser.add_argument('--setup', default='', help='code run after the import and before the timed call')
+    parser.add_argument('--call', default='pass', help='code timed after the import, e.g. the first use of a tokenizer')
+    parser.add_argument('--baseline', default=None, help='git revision to compare with (e.g. HEAD~1)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of processes per measurement (the median is reported)')
+    args = parser.parse_args()
+
+    baseline_dir = checkout_revision(args.baseline) if args.baseline is not None else None
+    for module in args.modules:
+        print(module)
+        report('  current', time_startup(module, pipeline_dir, args.setup, args.call, args.repeat))
+        if baseline_dir is not None:
+            report(f'  {args.baseline}', time_startup(module, baseline_dir, args.setup, args.call, args.repeat))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import os, time, shutil, tarfile
+from pathlib import PurePosixPath
+from vxc_processing import create_textgrid
+from vxc_clips import clip_dir, iter_clip_paths
+
+# Streaming ingestion of a Common Voice release
+# Instead of extracting the whole language folder of cv-corpus-<release>-<date>[-<lang_code>].tar.gz and then moving
+# the validated clips out of clips/ (and deleting the rest), the archive is read once, sequentially:
+# - the metadata files of the language (validated.tsv, clip_durations.tsv, ...) are extracted into the language folder,
+#   with the modification times of the archive, so that the clip manifest of a folder streamed again stays valid;
+# - as soon as validated.tsv and clip_durations.tsv are there, the clip table is built (e.g. by remap_spkr, which also
+#   drops the skiplisted speakers and the clips of 1s or less);
+# - every later clip of the table is written straight to validated/ (or to its subfolder of 32000 clips with
+#   sharded=True) together with its TextGrid, and the clips that are not in the table are never written.
+# The archives put the metadata files before the clips; if some clips come first anyway, they are written to clips/
+# and moved (or deleted) once the table is known, like move_and_create_tg does.
+
+table_inputs = ['validated.tsv', 'clip_durations.tsv']
+
+##########################################################################################################
+##########################################################################################################
+
+# The path of a member of the archive inside the language folder (e.g. 'clips/common_voice_eo_1.mp3'),
+# or None if it belongs to another language: the members are <cv-corpus-...>/<lang_code>/...
+# The members are written without tarfile's extraction filters, so names that could point outside the language folder
+# (absolute, or with '..') are refused.
+def member_path(name, lang_code):
+    parts = PurePosixPath(name).parts
+    if name.startswith(('/', '\\')) or '..' in parts or any('\\' in part or ':' in part for part in parts):
+        raise ValueError(f'Unsafe member name in the archive: {name}')
+    if len(parts) < 3 or parts[1] != lang_code:
+        return None
+    return '/'.join(parts[2:])
+
+# Write the content of a member to path (to a temporary file first, so an interrupted stream leaves no partial file)
+def write_member(tar, member, path):
+    tmp_path = f'{path}.part'
+    with tar.extractfile(member) as src, open(tmp_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    os.utime(tmp_path, (member.mtime, member.mtime))
+    os.replace(tmp_path, path)
+
+# The same file from an earlier stream of the archive
+def is_extracted(member, path):
+    if not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    return stat.st_size == member.size and int(stat.st_mtime) == int(member.mtime)
+
+# Where each clip of the table goes, with what its TextGrid needs: clip name: (path, speaker id, duration, transcript)
+def clip_targets(df, transcript, sharded):
+    kind = 'sub' if sharded and 'subfolder' in df.columns else 'new'
+    return {clip: target for clip, target in zip(df['path'], zip(iter_clip_paths(df, kind), df['speaker_id'], df['dur'], df[transcript]))}
+
+# Write a clip of the table and its TextGrid, unless they are already there (from an earlier stream); returns whether the clip was written
+def place_clip(target, write):
+    path, speaker, dur, transcript = target
+    written = not os.path.exists(path)
+    if written:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write(path)
+    tg_path = os.path.splitext(path)[0] + '.TextGrid'
+    if not os.path.exists(tg_path):
+        create_textgrid(path, dur, str(speaker), transcript)
+    return written
+
+# Stream the language lang_code out of the release archive into lang_dir and return the clip table.
+# clip_table() builds the table from the metadata files of lang_dir, e.g.
+#   lambda: vxcproc.remap_spkr(language_dir, spkr_file_path, lang_code)
+# transcript is the column written to the TextGrids ('sentence_tok' for the CJK languages and Thai).
+def stream_release(archive_path, lang_dir, lang_code, clip_table, transcript='sentence', sharded=False):
+    start = time.time()
+    os.makedirs(lang_dir, exist_ok=True)
+    clips_dir = os.path.join(lang_dir, 'clips')
+
+    df = None
+    targets = None
+    early_clips = []
+    n_clips = n_written = n_present = n_skipped = n_bytes = 0
+    with tarfile.open(archive_path, 'r|*') as tar:
+        for member in tar:
+            path = member_path(member.name, lang_code)
+            if path is None or member.isdir():
+                continue
+            # Only regular files are written (no links or devices)
+            if not member.isfile():
+                raise ValueError(f'Member of the archive that is not a regular file: {member.name}')
+            n_bytes += member.size
+
+            if not path.startswith('clips/'):
+                # Metadata file
+                dst = os.path.join(lang_dir, *path.split('/'))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if not is_extracted(member, dst):
+                    write_member(tar, member, dst)
+                continue
+
+            n_clips += 1
+            if targets is None and all(os.path.exists(os.path.join(lang_dir, name)) for name in table_inputs):
+                df = clip_table()
+                targets = clip_targets(df, transcript, sharded)
+                os.makedirs(clip_dir(df, 'new'), exist_ok=True)
+                print(f'{len(targets)} validated clips to write, from clip {n_clips} of the archive on.')
+
+            clip = path[len('clips/'):]
+            if '/' in clip:
+                raise ValueError(f'Unexpected clip path in the archive: {member.name}')
+            if targets is None:
+                # The table is not known yet: extract the clip as before
+                os.makedirs(clips_dir, exist_ok=True)
+                write_member(tar, member, os.path.join(clips_dir, clip))
+                early_clips.append(clip)
+            elif clip in targets:
+                if place_clip(targets.pop(clip), lambda dst: write_member(tar, member, dst)):
+                    n_written += 1
+                else:
+                    n_present += 1
+            else:
+                n_skipped += 1
+
+            if n_clips % 100000 == 0:
+                print(f'{n_clips} clips read ({n_bytes / (time.time() - start) / 1e6:.0f} MB/s).')
+
+    if targets is None:
+        df = clip_table()
+        targets = clip_targets(df, transcript, sharded)
+
+    # Clips that came before the metadata files
+    for clip in early_clips:
+        src = os.path.join(clips_dir, clip)
+        if clip in targets:
+            if place_clip(targets.pop(clip), lambda dst: shutil.move(src, dst)):
+                n_written += 1
+            else:
+                os.remove(src)
+                n_present += 1
+        else:
+            os.remove(src)
+            n_skipped += 1
+    if os.path.isdir(clips_dir) and len(os.listdir(clips_dir)) == 0:
+        os.rmdir(clips_dir)
+
+    elapsed = time.time() - start
+    print(f'{n_written} validated clips written with their TextGrids ({n_present} already there), {n_skipped} other clips skipped, '
+          f'{len(targets)} clips of the table not in the archive.')
+    print(f'{n_bytes / 1e9:.1f} GB streamed in {elapsed:.0f} seconds ({n_bytes / max(elapsed, 1e-9) / 1e6:.0f} MB/s).')
+    return df
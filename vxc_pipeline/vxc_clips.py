@@ -0,0 +1,53 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Compact clip table
+# The table returned by remap_spkr and remap_cjk_spkr has one row per clip with the clip name (the path column of
+# Common Voice), the speaker id as an integer, the duration and the transcript. The language folder is stored once,
+# in df.attrs (kept by pandas through slicing and filtering), and above 32000 clips the subfolder of each clip is
+# a categorical. The paths of the clips are not stored: they are derived when needed, either one at a time while
+# iterating (iter_clip_paths, used by the move/TextGrid/split helpers) or as a column (clip_paths).
+#   src: <lang_dir>/clips/<clip>                        where Common Voice puts the clips
+#   new: <lang_dir>/validated/<clip>                    where the validated clips and their TextGrids go
+#   sub: <lang_dir>/validated/<subfolder>/<clip>        the subfolders of 32000 clips for the alignment
+
+group_size = 32000
+
+# Turn the clip table built by build_validated (or loaded from the manifest) into the compact table
+def compact_clips(validated, lang_dir):
+    validated['speaker_id'] = validated['speaker_id'].astype('int32')
+
+    # If there are more than 32000 files, split them into groups of 32000 in the order of the table
+    if len(validated) > group_size:
+        num_groups = (len(validated) + group_size - 1) // group_size
+        validated['subfolder'] = pd.Categorical.from_codes(np.arange(len(validated)) // group_size,
+                                                           ['subfolder_' + str(i+1).zfill(3) for i in range(num_groups)])
+
+    validated.attrs['lang_dir'] = lang_dir
+    return validated
+
+def clip_dir(df, kind):
+    lang_dir = df.attrs['lang_dir']
+    if kind == 'src':
+        return os.path.join(lang_dir, 'clips')
+    elif kind in ['new', 'sub']:
+        return os.path.join(lang_dir, 'validated')
+    raise ValueError(f'Unknown kind of clip path: {kind}')
+
+# The paths of the clips of the table, one at a time
+def iter_clip_paths(df, kind):
+    root = clip_dir(df, kind)
+    if kind == 'sub':
+        for subfolder, clip in zip(df['subfolder'], df['path']):
+            yield os.path.join(root, subfolder, clip)
+    else:
+        for clip in df['path']:
+            yield os.path.join(root, clip)
+
+# The paths of the clips of the table as a column (vectorized string concatenation)
+def clip_paths(df, kind):
+    root = clip_dir(df, kind) + os.sep
+    if kind == 'sub':
+        return root + df['subfolder'].astype('str') + os.sep + df['path']
+    return root + df['path']
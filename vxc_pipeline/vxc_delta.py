@@ -0,0 +1,197 @@
+import os, re, json, shutil, argparse
+import numpy as np
+import pandas as pd
+from vxc_manifest import manifest_name
+from vxc_lexicon_cache import file_hash
+from vxc_clips import group_size
+
+# Release delta
+# Moving a language to a new Common Voice release mostly adds clips: the clips, sentences and speakers of the previous
+# release are nearly all still there. The delta compares the clip table of the new release with the manifest of the
+# previous processed release (<lang_code>_v<previous>/clip_manifest.parquet) and classifies each clip as
+#   added:      only in the new release
+#   removed:    only in the previous release
+#   changed:    in both, but with a different transcript, duration or speaker (processed again, like the added clips)
+#   unchanged:  in both, with the same transcript, duration and speaker
+#   stale:      unchanged, but the alignments of the previous release were made with another lexicon or acoustic model
+#               (set by reuse_outputs; processed again, like the added clips)
+# The delta is saved as release_delta.tsv in the new language folder and drives the later stages:
+# - the speaker ids of the previous release are kept (remap_spkr(previous_dir=...)), so its TextGrids stay valid;
+# - reuse_outputs copies the TextGrids of the unchanged clips from the previous release, and their alignments if the
+#   lexicon and the acoustic model are the same as for the previous release (alignment_stamp.json, next to the manifest);
+# - delta_corpus puts the added, changed and stale clips in a folder of their own (in subfolders of 32000 clips for large deltas),
+#   to be aligned with the same acoustic model;
+# - vxc_get_dur_f0_formants.py --previous_ver keeps the measurements of the unchanged clips and only processes the others.
+
+delta_name = 'release_delta.tsv'
+delta_corpus_name = 'validated_delta'
+stamp_name = 'alignment_stamp.json'
+
+##########################################################################################################
+##########################################################################################################
+
+# Folder of the same language in another release (<lang_code>_v<release>, next to lang_dir)
+def release_dir(lang_dir, release):
+    lang_dir = os.path.normpath(lang_dir)
+    lang_code = re.sub(r'_v[^_]+$', '', os.path.basename(lang_dir))
+    return os.path.join(os.path.dirname(lang_dir), f'{lang_code}_v{release}')
+
+# The clip table saved in the manifest of a processed release, whatever its inputs were
+def load_release_manifest(lang_dir):
+    import pyarrow.parquet as pq
+    path = os.path.join(lang_dir, manifest_name)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'No clip manifest in {lang_dir}: process that release with the current pipeline first')
+    return pq.read_table(path).to_pandas()
+
+# client_id: speaker_id of a processed release
+def release_speaker_ids(previous):
+    return dict(zip(previous['client_id'].astype(object), previous['speaker_id'].astype(int)))
+
+# Give the speakers in speaker_ids (client_id: speaker_id) their ids, and the other speakers the next ids
+# in order of appearance; speaker_ids is updated, so it can be used for the successive chunks of a table
+def carry_speaker_ids(validated, speaker_ids):
+    next_id = max(speaker_ids.values(), default=0) + 1
+    for client_id in validated['client_id'].astype(object).unique():
+        if client_id not in speaker_ids:
+            speaker_ids[client_id] = next_id
+            next_id += 1
+    validated['speaker_id'] = validated['client_id'].astype(object).map(speaker_ids).astype('str')
+    return validated
+
+# Wrap the build function of a clip table (see cached_manifest) so that the speakers keep the ids of the previous release
+def carry_build(build, previous_dir):
+    def carried_build():
+        speaker_ids = release_speaker_ids(load_release_manifest(previous_dir))
+        built = build()
+        if isinstance(built, pd.DataFrame):
+            return carry_speaker_ids(built, speaker_ids)
+        return (carry_speaker_ids(chunk, speaker_ids) for chunk in built)
+    return carried_build
+
+# Classify the clips of the new release against the previous one: returns a dataframe of path, status
+def release_delta(previous, validated):
+    transcript = 'sentence_tok' if 'sentence_tok' in validated.columns else 'sentence'
+    columns = ['path', transcript, 'dur', 'client_id']
+    new = validated[columns].astype({transcript: object, 'client_id': object})
+    old = previous[columns].astype({transcript: object, 'client_id': object})
+    merged = new.merge(old, on='path', how='outer', suffixes=('', '_old'), indicator=True)
+
+    same = ((merged[transcript].fillna('') == merged[transcript + '_old'].fillna(''))
+            & np.isclose(merged['dur'], merged['dur_old'])
+            & (merged['client_id'] == merged['client_id_old']))
+    merged['status'] = np.select([merged['_merge'] == 'left_only', merged['_merge'] == 'right_only', same],
+                                 ['added', 'removed', 'unchanged'], default='changed')
+    return merged[['path', 'status']]
+
+def save_delta(delta, lang_dir):
+    delta.to_csv(os.path.join(lang_dir, delta_name), sep='\t', index=False)
+
+def load_delta(lang_dir):
+    return pd.read_csv(os.path.join(lang_dir, delta_name), sep='\t', dtype='str')
+
+def report_delta(delta):
+    counts = delta['status'].value_counts()
+    print(', '.join(f'{counts.get(status, 0)} {status}' for status in ['unchanged', 'added', 'changed', 'stale', 'removed']) + ' clips.')
+
+# Hashes of the lexicon and the acoustic model the alignments of a release are made with
+def alignment_stamp(dict_file_path, acs_mod_path):
+    return {'lexicon': file_hash(dict_file_path), 'model': file_hash(acs_mod_path)}
+
+# Record the lexicon and the acoustic model of the alignments in the language folder (once the corpus is aligned)
+def save_alignment_stamp(lang_dir, dict_file_path, acs_mod_path):
+    with open(os.path.join(lang_dir, stamp_name), 'w') as f:
+        json.dump(alignment_stamp(dict_file_path, acs_mod_path), f)
+
+def load_alignment_stamp(lang_dir):
+    path = os.path.join(lang_dir, stamp_name)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+# Hard link a file of the same release (or copy it if the two folders are on different file systems)
+def link_file(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+# Copy the TextGrids of the unchanged clips from the previous release, wherever they are under a folder (e.g. in the subfolders of large corpora)
+# They are copied, not linked: aligning the new release writes to its output folder, which must not change the previous release.
+def copy_textgrids(unchanged, previous_folder, new_folder):
+    os.makedirs(new_folder, exist_ok=True)
+    n_copied = 0
+    for root, _, files in os.walk(previous_folder):
+        for name in files:
+            stem, ext = os.path.splitext(name)
+            if ext == '.TextGrid' and stem in unchanged and not os.path.exists(os.path.join(new_folder, name)):
+                shutil.copy2(os.path.join(root, name), os.path.join(new_folder, name))
+                n_copied += 1
+    print(f'{n_copied} TextGrids of unchanged clips copied to {new_folder}.')
+
+# Reuse the outputs of the unchanged clips: the input TextGrids in validated/ (they only depend on the transcript, duration and speaker)
+# and, if the lexicon and the acoustic model are the ones the previous release was aligned with, the alignments in the output folder.
+# Otherwise the unchanged clips become stale, to be aligned and measured again. Returns the delta (saved again if it changed).
+def reuse_outputs(delta, previous_dir, lang_dir, dict_file_path, acs_mod_path, output_folder='output'):
+    unchanged = set(os.path.splitext(path)[0] for path in delta.loc[delta['status'] == 'unchanged', 'path'])
+    copy_textgrids(unchanged, os.path.join(previous_dir, 'validated'), os.path.join(lang_dir, 'validated'))
+
+    previous_stamp = load_alignment_stamp(previous_dir)
+    stamp = alignment_stamp(dict_file_path, acs_mod_path)
+    if previous_stamp == stamp:
+        copy_textgrids(unchanged, os.path.join(previous_dir, output_folder), os.path.join(lang_dir, output_folder))
+        return delta
+
+    if previous_stamp is None:
+        print(f'No {stamp_name} in {previous_dir}: the alignments of the previous release are not reused.')
+    else:
+        changed = [part for part in previous_stamp if previous_stamp[part] != stamp.get(part)]
+        print(f'The {" and the ".join(changed)} changed since the previous release: its alignments are not reused.')
+    delta.loc[delta['status'] == 'unchanged', 'status'] = 'stale'
+    save_delta(delta, lang_dir)
+    report_delta(delta)
+    return delta
+
+# Link the sound files and TextGrids of the added, changed and stale clips (in validated/) into a corpus folder of their own,
+# so that only they are aligned. Above 32000 clips, they are put in subfolders of 32000 clips (to be aligned with mfa_align.sh).
+# Returns the folder.
+def delta_corpus(delta, lang_dir):
+    corpus_dir = os.path.join(lang_dir, delta_corpus_name)
+    validated_dir = os.path.join(lang_dir, 'validated')
+    paths = delta.loc[delta['status'].isin(['added', 'changed', 'stale']), 'path'].tolist()
+    sharded = len(paths) > group_size
+    n_clips = 0
+    missing = []
+    for path in paths:
+        src = os.path.join(validated_dir, path)
+        if not os.path.exists(src):
+            missing.append(path)
+            continue
+        folder = os.path.join(corpus_dir, 'subfolder_' + str(n_clips // group_size + 1).zfill(3)) if sharded else corpus_dir
+        os.makedirs(folder, exist_ok=True)
+        for name in [path, os.path.splitext(path)[0] + '.TextGrid']:
+            dst = os.path.join(folder, name)
+            if os.path.exists(os.path.join(validated_dir, name)) and not os.path.exists(dst):
+                link_file(os.path.join(validated_dir, name), dst)
+        n_clips += 1
+    print(f'{n_clips} clips to align linked into {corpus_dir}' + (f' (in subfolders of {group_size} clips).' if sharded else '.'))
+    if len(missing) > 0:
+        print(f'Warning: {len(missing)} clips to align are not in {validated_dir}, e.g. {missing[0]}.')
+    return corpus_dir
+
+##########################################################################################################
+##########################################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the clip manifests of two processed Common Voice releases of a language')
+    parser.add_argument('lang_dir', help='folder of the new release (<lang_code>_v<release>)')
+    parser.add_argument('previous_ver', help='the previous release, e.g. 17')
+    args = parser.parse_args()
+
+    delta = release_delta(load_release_manifest(release_dir(args.lang_dir, args.previous_ver)), load_release_manifest(args.lang_dir))
+    save_delta(delta, args.lang_dir)
+    report_delta(delta)
+
+if __name__ == "__main__":
+    main()
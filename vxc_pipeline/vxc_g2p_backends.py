@@ -0,0 +1,152 @@
+import os, time, threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from vxc_lexicon_cache import cache_lookup, cache_store
+
+# Common interface of the G2P backends
+# Every G2P engine (Epitran, XPF, Charsiu, MFA, and the CJK converters) is wrapped in a G2PBackend:
+# a batch of words goes in and (word, pronunciation) pairs come out. The backends also say whether they can be used
+# from several threads at once and roughly how expensive they are, so that run_g2p can decide how to run them:
+# in the calling process, on a thread pool, or on a process pool. Several languages can be converted in one run_g2p call.
+# The backends are defined next to the code they wrap (vxc_processing, vxc_processing_cjk, chr_g2p, mfa_g2p).
+
+##########################################################################################################
+##########################################################################################################
+
+class G2PBackend:
+    engine = None       # engine name in the G2P cache
+    thread_safe = False # convert can be called from several threads at the same time on one loaded backend
+    picklable = True    # the (unloaded) backend can be sent to a worker process and loaded there
+    load_cost = 0.1     # seconds it takes to load the backend (cost hint)
+    word_cost = 1e-4    # seconds per word (cost hint)
+    batch_size = 1000   # number of words per batch given to convert
+
+    def __init__(self, lang):
+        self.lang = lang
+        self.loaded = None
+
+    # Heavy state (models, rule sets) is created here, once per process, and kept in self.loaded
+    def load(self):
+        pass
+
+    # Hash of everything that can change the output (for the G2P cache)
+    def version(self):
+        raise NotImplementedError
+
+    # Convert a batch of words: returns (word, pronunciation) pairs; words that could not be converted are left out
+    def convert(self, words):
+        raise NotImplementedError
+
+    def ensure_loaded(self):
+        if self.loaded is None:
+            self.load()
+            if self.loaded is None:
+                self.loaded = True
+        return self
+
+    # The loaded state stays in the process where it was created
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['loaded'] = None
+        return state
+
+    def key(self):
+        return (type(self).__name__, self.lang, tuple(sorted((k, repr(v)) for k, v in self.__dict__.items() if k != 'loaded')))
+
+##########################################################################################################
+##########################################################################################################
+
+# Backends loaded in a worker process, so each one is loaded once per worker
+worker_backends = {}
+
+def worker_backend(backend):
+    key = backend.key()
+    if key not in worker_backends:
+        worker_backends[key] = backend.ensure_loaded()
+    return worker_backends[key]
+
+def process_batch(backend, words):
+    return list(worker_backend(backend).convert(words))
+
+# How to run a backend on n_words words: 'inline' if it is too cheap to be worth spreading over workers,
+# 'thread' if it is thread-safe (including backends that wait on subprocesses or release the GIL), 'process' otherwise
+def choose_mode(backend, n_words, n_workers, min_seconds=1.0):
+    if n_workers <= 1 or n_words * backend.word_cost < min_seconds:
+        return 'inline'
+    if backend.thread_safe:
+        return 'thread'
+    if backend.picklable:
+        return 'process'
+    return 'inline'
+
+# Run G2P on several (backend, words) tasks, e.g. one per language, sharing n_workers workers.
+# Only the words that are not in the G2P cache (if any) are converted.
+# mode forces one of 'inline', 'thread', 'process' for all the tasks; by default it is chosen per backend (see choose_mode).
+# n_workers defaults to the number of CPUs.
+# Returns a dict of word: pronunciation (None for failures) for each task, in the order of the tasks.
+def run_g2p(tasks, n_workers=None, cache=None, mode=None):
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    lookups = []
+    for backend, words in tasks:
+        version = backend.version()
+        lex_dict, new_words = cache_lookup(words, backend.engine, version, backend.lang, cache)
+        lookups.append((version, lex_dict, new_words))
+
+    thread_pool = None
+    process_pool = None
+    load_lock = threading.Lock()
+
+    def load_shared(backend):
+        with load_lock:
+            return backend.ensure_loaded()
+
+    start = time.time()
+    try:
+        # Submit the batches of all the tasks to the pools first, so that the languages are converted concurrently,
+        # then convert the inline tasks while the pools are busy
+        modes = []
+        futures = []
+        for (backend, words), (version, lex_dict, new_words) in zip(tasks, lookups):
+            task_mode = mode or choose_mode(backend, len(new_words), n_workers)
+            batches = [new_words[i:i + backend.batch_size] for i in range(0, len(new_words), backend.batch_size)]
+            if task_mode == 'thread':
+                if thread_pool is None:
+                    thread_pool = ThreadPoolExecutor(n_workers)
+                futures.append([thread_pool.submit(lambda backend, batch: list(load_shared(backend).convert(batch)), backend, batch) for batch in batches])
+            elif task_mode == 'process':
+                if process_pool is None:
+                    process_pool = ProcessPoolExecutor(n_workers)
+                futures.append([process_pool.submit(process_batch, backend, batch) for batch in batches])
+            else:
+                futures.append(batches)
+            modes.append(task_mode)
+            print(f'G2P ({backend.engine}, {backend.lang}): {len(new_words)} words in {len(batches)} batches ({task_mode}).')
+
+        results = [[list(backend.ensure_loaded().convert(batch)) for batch in batches] if task_mode == 'inline' else None
+                   for (backend, words), task_mode, batches in zip(tasks, modes, futures)]
+
+        lex_dicts = []
+        for (backend, words), (version, lex_dict, new_words), task_mode, task_futures, task_results in zip(tasks, lookups, modes, futures, results):
+            if task_mode != 'inline':
+                task_results = [future.result() for future in task_futures]
+            pairs = [pair for batch in task_results for pair in batch]
+            cache_store(lex_dict, new_words, pairs, backend.engine, version, backend.lang, cache)
+            lex_dicts.append(lex_dict)
+    finally:
+        # If a batch failed, the batches not started yet are cancelled
+        for pool in [thread_pool, process_pool]:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+    print(f'G2P of {len(tasks)} tasks done in {time.time() - start:.1f} seconds.')
+
+    return lex_dicts
+
+# Write a lexicon from the result of run_g2p, in the order of the words (or sorted), leaving out the failures
+def write_lexicon(lex_dict, words, dict_file_path, sort=False):
+    words = sorted(lex_dict) if sort else words
+    with open(dict_file_path, 'w') as dict_file:
+        for word in words:
+            phone = lex_dict[word]
+            if phone is not None and phone.strip() != '':
+                dict_file.write(word + '\t' + phone + '\n')
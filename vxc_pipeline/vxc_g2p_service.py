@@ -0,0 +1,222 @@
+import os, sys, json, time, socket, socketserver, argparse
+from collections import OrderedDict
+
+# Warm G2P service
+# Loading a G2P backend (importing transformers and the byT5 checkpoint for Charsiu, an Epitran instance, an XPF rule set)
+# costs more than converting the words of most languages. This service runs in the background, listens on a Unix socket
+# and keeps the most recently used backends loaded, so that processing many languages in a row (or re-running the notebook)
+# loads each backend once. Start it with `python vxc_g2p_service.py` and pass its socket path to the G2P functions.
+#
+# Protocol: one JSON object per line in each direction.
+#   {"command": "load", "engine": ..., "lang": ..., "options": {...}}    -> {"version": ...}
+#   {"command": "g2p", "engine": ..., "lang": ..., "options": {...}, "words": [...]}    -> {"results": [...]}
+#   {"command": "stats"}    -> {"backends": [...]}
+#   {"command": "shutdown"}    -> {}
+# Errors are returned as {"error": message}.
+
+service_path = os.path.join(os.path.expanduser('~'), '.cache', 'voxcommunis', 'g2p_service.sock')
+
+##########################################################################################################
+##########################################################################################################
+
+# Backend loaders: take the language code (and options) and return (convert, version),
+# where convert takes a list of words and returns a list of results in the format of the engine:
+#   epi: (word, phone, clean_phone) triples, as epi_transliterate
+#   xpf: (word, translation) pairs, as alphabet2ipa.translate_many (lang is the path of the rules file)
+#   chr: (word, phone) pairs, as charsiu_g2p_batched
+
+def load_epi(epi_code, options):
+    import epitran
+    from vxc_processing import epi_convert, epi_version
+    epi = epitran.Epitran(epi_code)
+    return (lambda words: epi_convert(epi, words, epi_code)), epi_version(epi_code)
+
+def load_xpf(rule_file_path, options):
+    from xpf_translate04 import load, CACHE_DIR
+    from vxc_processing import xpf_version
+    with open(rule_file_path, 'r', encoding='utf8') as rule_file, open(options['verify_file_path'], 'r', encoding='utf8') as verify_file:
+        a2ipa, verified = load(rule_file, verify_file, cachedir=CACHE_DIR)
+    if not verified:
+        raise ValueError('Verification failed, not processing additional data')
+    return (lambda words: list(a2ipa.translate_many(words))), xpf_version(rule_file_path)
+
+def load_chr(code_chr, options):
+    # The model itself is loaded once, for the first Charsiu backend, and shared by the others
+    import chr_g2p
+    chr_g2p.load_model()
+    token_budget = options.get('token_budget', 4096)
+    return (lambda words: chr_g2p.charsiu_g2p_batched(words, code_chr, token_budget)), chr_g2p.chr_version()
+
+backend_loaders = {'epi': load_epi, 'xpf': load_xpf, 'chr': load_chr}
+
+# The files a backend is loaded from, besides the code: a backend is loaded again when one of them changes
+backend_files = {'xpf': lambda rule_file_path, options: [rule_file_path, options['verify_file_path']]}
+
+def file_stamp(paths):
+    return [(path, os.stat(path).st_size, os.stat(path).st_mtime_ns) if os.path.exists(path) else (path, None, None) for path in paths]
+
+# Modification times of the pipeline modules imported by the service (xpf_translate04, vxc_processing, vxc_ipa, ...)
+pipeline_dir = os.path.dirname(os.path.abspath(__file__))
+
+def code_stamp():
+    paths = [module.__file__ for module in list(sys.modules.values())
+             if getattr(module, '__file__', None) and os.path.dirname(os.path.abspath(module.__file__)) == pipeline_dir]
+    return dict((path, (size, mtime)) for path, size, mtime in file_stamp(sorted(paths)))
+
+##########################################################################################################
+##########################################################################################################
+
+# Loaded backends, least recently used first
+# The code of the pipeline modules can't be replaced in a running service: if a module changed on disk since it was
+# imported, the backends are refused (instead of converting with the old code under the version of the new one).
+class BackendCache:
+    def __init__(self, max_backends=8):
+        self.max_backends = max_backends
+        self.backends = OrderedDict()
+        self.code = {}
+
+    # Record the modules imported since the last check, and fail if one of the others changed
+    def check_code(self):
+        current = code_stamp()
+        changed = [path for path, stamp in self.code.items() if current.get(path, stamp) != stamp]
+        if len(changed) > 0:
+            raise RuntimeError(f'{", ".join(os.path.basename(path) for path in changed)} changed since the service imported it: restart the service')
+        for path, stamp in current.items():
+            self.code.setdefault(path, stamp)
+
+    def get(self, engine, lang, options):
+        files = backend_files[engine](lang, options) if engine in backend_files else []
+        key = (engine, lang, json.dumps(options, sort_keys=True), json.dumps(file_stamp(files)))
+        self.check_code()
+        if key in self.backends:
+            self.backends.move_to_end(key)
+            backend = self.backends[key]
+        else:
+            # The same backend loaded from older versions of its files
+            for old_key in [old_key for old_key in self.backends if old_key[:3] == key[:3]]:
+                del self.backends[old_key]
+                print(f'Unloaded {engine} backend for {lang}: its files changed.', flush=True)
+            start = time.time()
+            convert, version = backend_loaders[engine](lang, options)
+            self.check_code()
+            backend = {'convert': convert, 'version': version, 'load_time': time.time() - start, 'n_words': 0}
+            print(f'Loaded {engine} backend for {lang} in {backend["load_time"]:.1f} seconds.', flush=True)
+            self.backends[key] = backend
+            if len(self.backends) > self.max_backends:
+                (old_engine, old_lang, _, _), _ = self.backends.popitem(last=False)
+                print(f'Unloaded {old_engine} backend for {old_lang}.', flush=True)
+        return backend
+
+    def stats(self):
+        return [{'engine': engine, 'lang': lang, 'version': backend['version'],
+                 'load_time': backend['load_time'], 'n_words': backend['n_words']}
+                for (engine, lang, _, _), backend in self.backends.items()]
+
+# Requests are handled one at a time: the backends are not thread-safe
+class G2PHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            command = None
+            try:
+                request = json.loads(line)
+                command = request.get('command', 'g2p')
+                if command == 'shutdown':
+                    response = {}
+                elif command == 'stats':
+                    response = {'backends': self.server.backends.stats()}
+                else:
+                    backend = self.server.backends.get(request['engine'], request['lang'], request.get('options', {}))
+                    if command == 'load':
+                        response = {'version': backend['version']}
+                    else:
+                        start = time.time()
+                        results = backend['convert'](request['words'])
+                        backend['n_words'] += len(request['words'])
+                        print(f'{request["engine"]} ({request["lang"]}): {len(request["words"])} words in {time.time() - start:.1f} seconds.', flush=True)
+                        response = {'results': results}
+            except Exception as e:
+                response = {'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write((json.dumps(response, ensure_ascii=False) + '\n').encode('utf8'))
+            self.wfile.flush()
+            if command == 'shutdown':
+                self.server.running = False
+                return
+
+class G2PServer(socketserver.UnixStreamServer):
+    def __init__(self, path, max_backends=8):
+        self.backends = BackendCache(max_backends)
+        self.running = True
+        super().__init__(path, G2PHandler)
+
+def serve(path=service_path, max_backends=8):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Remove the socket left behind by a service that did not shut down cleanly
+    if os.path.exists(path):
+        if service_running(path):
+            sys.exit(f'A G2P service is already running on {path}')
+        os.remove(path)
+
+    with G2PServer(path, max_backends) as server:
+        print(f'G2P service listening on {path}', flush=True)
+        try:
+            while server.running:
+                server.handle_request()
+        except KeyboardInterrupt:
+            pass
+    os.remove(path)
+
+##########################################################################################################
+##########################################################################################################
+
+# Client
+
+class G2PServiceError(Exception):
+    pass
+
+def service_request(request, path=service_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        with sock.makefile('rwb') as stream:
+            stream.write((json.dumps(request, ensure_ascii=False) + '\n').encode('utf8'))
+            stream.flush()
+            response = json.loads(stream.readline())
+    if 'error' in response:
+        raise G2PServiceError(response['error'])
+    return response
+
+def service_running(path=service_path):
+    try:
+        service_request({'command': 'stats'}, path)
+        return True
+    except (OSError, ValueError):
+        return False
+
+# Load a backend (if it is not loaded yet) and return its G2P version
+def service_load(engine, lang, options=None, path=service_path):
+    return service_request({'command': 'load', 'engine': engine, 'lang': lang, 'options': options or {}}, path)['version']
+
+# Convert a batch of words with a backend of the service; the results are lists in the format of the engine (see above)
+def service_g2p(engine, lang, words, options=None, path=service_path):
+    request = {'command': 'g2p', 'engine': engine, 'lang': lang, 'options': options or {}, 'words': list(words)}
+    return [tuple(result) for result in service_request(request, path)['results']]
+
+##########################################################################################################
+##########################################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='G2P service keeping Epitran, XPF and Charsiu backends loaded between runs')
+    parser.add_argument('command', nargs='?', choices=['serve', 'stats', 'shutdown'], default='serve', help='start the service, show the loaded backends, or stop it')
+    parser.add_argument('--socket', default=service_path, help='path of the Unix socket')
+    parser.add_argument('--max_backends', type=int, default=8, help='number of backends kept loaded')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.socket, args.max_backends)
+    elif args.command == 'stats':
+        for backend in service_request({'command': 'stats'}, args.socket)['backends']:
+            print(f"{backend['engine']}\t{backend['lang']}\t{backend['version']}\t{backend['load_time']:.1f}s\t{backend['n_words']} words")
+    else:
+        service_request({'command': 'shutdown'}, args.socket)
+
+if __name__ == "__main__":
+    main()
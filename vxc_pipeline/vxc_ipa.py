@@ -0,0 +1,207 @@
+import re, sys, argparse
+from functools import lru_cache
+import numpy as np
+
+# IPA segmentation and sanitizing shared by all the G2P paths
+# Same output as lingpy's ipa2tokens with its default settings (optionally without merging vowels), but:
+# - the symbol classes (breaks, tie bars, stress marks, diacritics and length marks, vowels, tones) are looked up in
+#   a table built once from lingpy's own symbol lists, instead of testing each character against every list;
+# - the segmentation of each distinct string is memoized, since the same syllables and words come back over and over;
+# - segment_ipa_many segments a whole word list.
+# Unlike ipa2tokens, a string without tokens (empty, or only breaks) gives an empty segmentation instead of an IndexError.
+# `python vxc_ipa.py check lexicon.txt ...` compares the segmentation with ipa2tokens on the pronunciations of lexicons.
+
+BREAK, COMBINER, STRESS, DIACRITIC, VOWEL, TONE, CONSONANT = range(7)
+
+# Symbol class of each character (anything not in the table is a consonant), and the set of vowels
+@lru_cache(maxsize=None)
+def ipa_tables():
+    from lingpy.settings import rcParams
+    # ipa2tokens checks the classes in this order, so a character listed in two classes gets the first one
+    classes = {}
+    for symbol_class, chars in reversed([(BREAK, rcParams['breaks']), (COMBINER, rcParams['combiners']),
+                                         (STRESS, rcParams['stress']), (DIACRITIC, rcParams['diacritics']),
+                                         (VOWEL, rcParams['vowels']), (TONE, rcParams['tones'])]):
+        for char in chars:
+            classes[char] = symbol_class
+    return classes, frozenset(rcParams['vowels'])
+
+# Version of the segmentation and the sanitizer for the G2P cache: this file and the lingpy symbol lists it uses
+@lru_cache(maxsize=None)
+def ipa_version():
+    from vxc_lexicon_cache import file_hash, package_version
+    return file_hash(__file__) + '-lingpy-' + package_version('lingpy')
+
+def ipa_tokens(sequence, merge_vowels=True):
+    if ' ' in sequence:
+        raise ValueError("Input must not contain spaces")
+    classes, vowels = ipa_tables()
+
+    out = []
+    vowel = False
+    tone = False
+    merge = False
+    start = True
+    for char in sequence:
+        symbol_class = classes.get(char, CONSONANT)
+        # Breaks start a new token
+        if symbol_class == BREAK:
+            start = True
+            vowel = False
+            tone = False
+            merge = False
+        # Tie bars join the previous token with the next character
+        elif symbol_class == COMBINER:
+            if len(out) == 0:
+                out = ['∅' + char]
+                merge = False
+            else:
+                out[-1] += char
+                merge = True
+        elif symbol_class == STRESS:
+            out.append(char)
+            merge = True
+            tone = False
+            vowel = False
+            start = False
+        elif merge:
+            out[-1] += char
+            if char in vowels:
+                vowel = True
+            merge = False
+        elif symbol_class == DIACRITIC:
+            if not start:
+                out[-1] += char
+            else:
+                out.append(char)
+                start = False
+                merge = True
+        elif symbol_class == VOWEL:
+            # Sequences of vowels are diphthongs
+            if vowel and merge_vowels:
+                out[-1] += char
+            else:
+                out.append(char)
+                vowel = True
+            start = False
+            tone = False
+        elif symbol_class == TONE:
+            vowel = False
+            if tone:
+                out[-1] += char
+            else:
+                out.append(char)
+                tone = True
+            start = False
+        else:
+            vowel = False
+            out.append(char)
+            start = False
+            tone = False
+
+    # Merge geminates
+    tokens = out[:1]
+    for previous, token in zip(out, out[1:]):
+        if token == previous:
+            tokens[-1] += token
+        else:
+            tokens.append(token)
+    return tokens
+
+# Segmentation of an IPA string as space-separated tokens, i.e. ' '.join(ipa2tokens(sequence))
+@lru_cache(maxsize=2**18)
+def segment_ipa(sequence, merge_vowels=True):
+    return ' '.join(ipa_tokens(sequence, merge_vowels))
+
+def segment_ipa_many(sequences, merge_vowels=True):
+    return [segment_ipa(sequence, merge_vowels) for sequence in sequences]
+
+##########################################################################################################
+##########################################################################################################
+
+# IPA sanitizer shared by all the G2P modules
+# The symbols kept in pronunciations are those of these Unicode blocks (Latin, IPA extensions, modifier letters,
+# combining diacritics, Greek, phonetic extensions, punctuation, super/subscripts, arrows, Latin extended C and D),
+# plus white space. Everything else (e.g. characters of the original script that G2P left in) is removed.
+ipa_ranges = [(0x0020, 0x007E), (0x00A0, 0x00FF), (0x0100, 0x017F), (0x0180, 0x024F), (0x0250, 0x02AF), (0x02B0, 0x02FF),
+              (0x0300, 0x036F), (0x0370, 0x03FF), (0x1AB0, 0x1AFF), (0x1DC0, 0x1DFF), (0x2000, 0x206F), (0x2070, 0x209F),
+              (0x2190, 0x21FF), (0x2C60, 0x2C7F), (0xA700, 0xA71F)]
+ipa_extra = 'ẽ'
+
+# The patterns are built once from the table. (str.translate with a lookup table was tried as well,
+# but it is several times slower than the regex engine on non-ASCII text in CPython.)
+ipa_class = re.escape(ipa_extra) + ''.join(f'\\u{low:04X}-\\u{high:04X}' for low, high in ipa_ranges)
+ipa_pieces = re.compile(f'[{ipa_class}]+|\\s')
+ipa_only = re.compile(f'[{ipa_class}]*')
+ipa_or_spaces = re.compile(f'[{ipa_class}\\s]*')
+white_spaces = re.compile(r'\s+')
+
+@lru_cache(maxsize=None)
+def remove_pattern(remove):
+    return re.compile(f'[{re.escape(remove)}]+')
+
+# Remove the non-IPA symbols of a pronunciation (each run of them becomes a space between the IPA pieces),
+# then the symbols in `remove` (e.g. stress marks); with collapse_spaces, runs of white space become single spaces
+def clean_ipa(phone, remove='', collapse_spaces=False):
+    # Most pronunciations have nothing to remove
+    clean_phone = phone if ipa_only.fullmatch(phone) else ' '.join(ipa_pieces.findall(phone))
+    if remove != '':
+        clean_phone = remove_pattern(remove).sub('', clean_phone)
+    if collapse_spaces:
+        clean_phone = white_spaces.sub(' ', clean_phone)
+    return clean_phone
+
+# Clean a whole column of pronunciations: returns the cleaned pronunciations and a boolean mask of the modified ones
+def sanitize_ipa(phones, remove='', collapse_spaces=False):
+    phones = list(phones)
+    clean_phones = [clean_ipa(phone, remove, collapse_spaces) for phone in phones]
+    modified = np.fromiter((clean_phone != phone for phone, clean_phone in zip(phones, clean_phones)), dtype=bool, count=len(phones))
+    return clean_phones, modified
+
+# The string if it only has IPA symbols and white space, '' otherwise
+def filter_ipa_symbols(input_string):
+    return input_string if ipa_or_spaces.fullmatch(input_string) else ''
+
+##########################################################################################################
+##########################################################################################################
+
+# Compare segment_ipa with ipa2tokens on the pronunciations of lexicons (word<TAB>space-separated pronunciation)
+def check_lexicons(paths, merge_vowels=True, max_report=20):
+    from lingpy import ipa2tokens
+    n_checked = 0
+    diffs = []
+    for path in paths:
+        with open(path, 'r', encoding='utf8') as lexicon:
+            for line in lexicon:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 2:
+                    continue
+                # Each token of the pronunciation, and the whole pronunciation with the spaces removed
+                for sequence in fields[1].split(' ') + [fields[1].replace(' ', '')]:
+                    if sequence == '':
+                        continue
+                    n_checked += 1
+                    try:
+                        expected = ' '.join(ipa2tokens(sequence, merge_vowels=merge_vowels))
+                    except IndexError:
+                        expected = ''
+                    if segment_ipa(sequence, merge_vowels) != expected:
+                        diffs.append((sequence, segment_ipa(sequence, merge_vowels), expected))
+
+    for sequence, got, expected in diffs[:max_report]:
+        print(f'{sequence}\t{got}\t{expected} (ipa2tokens)')
+    print(f'{len(diffs)} of {n_checked} segmentations differ from ipa2tokens.')
+    return len(diffs) == 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the IPA segmentation against lingpy.ipa2tokens')
+    parser.add_argument('command', choices=['check'], help='compare with ipa2tokens on the pronunciations of lexicons')
+    parser.add_argument('lexicons', nargs='+', help='lexicon files: word<TAB>pronunciation')
+    parser.add_argument('--no_merge_vowels', action='store_true', help='segment vowels separately (merge_vowels=False)')
+    args = parser.parse_args()
+
+    ok = check_lexicons(args.lexicons, not args.no_merge_vowels)
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
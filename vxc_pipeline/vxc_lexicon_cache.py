@@ -0,0 +1,220 @@
+import os, sqlite3, hashlib, inspect, argparse
+from importlib import metadata
+
+# Cross-release G2P lexicon cache
+# Most word types of a Common Voice release were already in the previous one, so their pronunciations are kept in
+# a local SQLite database keyed by (G2P engine, version, language code, word) and only new word types go through G2P.
+# The version is a hash of everything that can change the output (engine version, rules file, post-processing code,
+# see g2p_version), so changing any of them makes the old entries unreachable; they can then be dropped with
+# `python vxc_lexicon_cache.py prune --version ...`. Lookups never delete entries: the entries of another configuration
+# (e.g. Charsiu with --int8) stay valid for the runs that use it.
+
+cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'voxcommunis', 'g2p_lexicon.sqlite')
+
+##########################################################################################################
+##########################################################################################################
+
+# Version of an installed package, used as part of the G2P version
+def package_version(name):
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+# Hash of a file's contents (e.g. an XPF rules file)
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+# Hash the parts that determine a G2P output: strings, numbers, functions (their source code is hashed), and lists/dicts of those
+def g2p_version(*parts):
+    digest = hashlib.sha1()
+
+    def add(part):
+        if isinstance(part, dict):
+            for key in sorted(part):
+                add(key)
+                add(part[key])
+        elif isinstance(part, (list, tuple)):
+            for item in part:
+                add(item)
+        elif callable(part):
+            add(inspect.getsource(part))
+        else:
+            digest.update(repr(part).encode('utf8'))
+            digest.update(b'\0')
+
+    add(parts)
+    return digest.hexdigest()[:16]
+
+##########################################################################################################
+##########################################################################################################
+
+# SQLite table of cached values, keyed by scope columns (ending with the version) and an item.
+# Subclasses set the table and column names; invalidate, prune and stats work on the scope columns, also in the
+# extra tables that share them (e.g. usage counts). Used by LexiconCache and vxc_sentence_cache.SentenceCache.
+class KeyValueCache:
+    table = None
+    scope = ()  # in the order of the primary key, e.g. ('engine', 'version', 'lang')
+    stats_columns = ()  # the scope columns in the order stats groups and reports them
+    stats_extra = ()  # the names of the values stats reports after the number of entries
+    item = None
+    value = None
+    extra_tables = ()
+    batch_size = 500
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.con = sqlite3.connect(path)
+        key = [*self.scope, self.item]
+        self.con.execute(f'''CREATE TABLE IF NOT EXISTS {self.table} (
+                                {', '.join(column + ' TEXT' for column in key + [self.value])},
+                                PRIMARY KEY ({', '.join(key)}))''')
+        self.con.commit()
+
+    # Cached values of the items for the scope key (a tuple in the order of scope), as a dict of item: value.
+    # Only the requested items are read, batch_size at a time (SQLite limits the number of parameters of a query).
+    def lookup_items(self, key, items):
+        items = list(dict.fromkeys(items))
+        scope_query = ' AND '.join(f'{column} = ?' for column in self.scope)
+        found = {}
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            rows = self.con.execute(f'SELECT {self.item}, {self.value} FROM {self.table} WHERE {scope_query} '
+                                    f'AND {self.item} IN ({", ".join("?" * len(batch))})', (*key, *batch))
+            found.update(rows)
+        return found
+
+    # Store (item, value) pairs for the scope key
+    def store_items(self, key, pairs):
+        self.con.executemany(f'INSERT OR REPLACE INTO {self.table} VALUES ({", ".join("?" * (len(self.scope) + 2))})',
+                             ((*key, item, value) for item, value in pairs))
+        self.con.commit()
+
+    # Delete entries; the scope columns left out (or None) match everything
+    def invalidate(self, **conditions):
+        query, args = self._where(conditions)
+        n = self.con.execute(f'DELETE FROM {self.table}' + query, args).rowcount
+        for table in self.extra_tables:
+            self.con.execute(f'DELETE FROM {table}' + query, args)
+        self.con.commit()
+        return n
+
+    # Delete the entries of the other scope columns (e.g. engine and language) made by any version other than the current one
+    def prune(self, version, **conditions):
+        query, args = self._where(conditions)
+        query, args = (query + ' AND' if query else ' WHERE') + ' version != ?', args + (version,)
+        n = self.con.execute(f'DELETE FROM {self.table}' + query, args).rowcount
+        for table in self.extra_tables:
+            self.con.execute(f'DELETE FROM {table}' + query, args)
+        self.con.commit()
+        return n
+
+    # Number of entries per scope
+    def stats(self, **conditions):
+        query, args = self._where(conditions)
+        columns = ', '.join(self.stats_columns)
+        return self.con.execute(f'SELECT {columns}, COUNT(*) FROM {self.table}' + query +
+                                f' GROUP BY {columns} ORDER BY {columns}', args).fetchall()
+
+    def _where(self, conditions, prefix=''):
+        conditions = [(column, value) for column, value in conditions.items() if value is not None]
+        if len(conditions) == 0:
+            return '', ()
+        return ' WHERE ' + ' AND '.join(f'{prefix}{column} = ?' for column, _ in conditions), tuple(value for _, value in conditions)
+
+    def close(self):
+        self.con.close()
+
+# pron is NULL for words the engine could not convert, so they are not retried either
+class LexiconCache(KeyValueCache):
+    table = 'lexicon'
+    scope = ('engine', 'version', 'lang')
+    stats_columns = ('engine', 'lang', 'version')
+    item = 'word'
+    value = 'pron'
+
+    def __init__(self, path=cache_path):
+        super().__init__(path)
+
+    # Cached pronunciations of the words, as a dict of word: pronunciation
+    def lookup(self, engine, version, lang, words):
+        return self.lookup_items((engine, version, lang), words)
+
+    # Store (word, pronunciation) pairs
+    def store(self, engine, version, lang, pairs):
+        self.store_items((engine, version, lang), pairs)
+
+# Run G2P only on the words that are not in the cache.
+# g2p takes a list of words and returns (word, pronunciation) pairs; words it leaves out are cached as failures (None).
+# Returns a dict of word: pronunciation (None for failures) for all the words.
+def cached_g2p(words, g2p, engine, version, lang, cache=None):
+    lex_dict, new_words = cache_lookup(words, engine, version, lang, cache)
+    pairs = g2p(new_words) if len(new_words) > 0 else []
+    cache_store(lex_dict, new_words, pairs, engine, version, lang, cache)
+    return lex_dict
+
+# The two halves of cached_g2p, for callers that run G2P for several languages at once (see vxc_g2p_backends):
+# cache_lookup returns the cached pronunciations and the word types still to convert,
+# cache_store adds the converted (word, pronunciation) pairs to lex_dict and to the cache.
+def cache_lookup(words, engine, version, lang, cache=None):
+    if cache is None:
+        return {}, list(dict.fromkeys(words))
+
+    lex_dict = cache.lookup(engine, version, lang, words)
+    new_words = list(dict.fromkeys(word for word in words if word not in lex_dict))
+    return lex_dict, new_words
+
+def cache_store(lex_dict, new_words, pairs, engine, version, lang, cache=None):
+    n_hits = len(lex_dict)
+    new_dict = {word: None for word in new_words}
+    new_dict.update(pairs)
+    lex_dict.update(new_dict)
+    if cache is None:
+        return
+
+    if len(new_dict) > 0:
+        cache.store(engine, version, lang, new_dict.items())
+    n_words = n_hits + len(new_words)
+    hit_rate = n_hits / n_words if n_words > 0 else 0
+    print(f'G2P cache ({engine}, {lang}): {n_hits} of {n_words} word types cached ({hit_rate:.1%}), {len(new_words)} converted.')
+
+##########################################################################################################
+##########################################################################################################
+
+# Command line of a cache: `stats` shows the entries per scope (filtered by the scope columns given), `invalidate` deletes them,
+# and `prune --version ...` deletes the entries of the other versions (of the scope given, e.g. one engine and language).
+# column_help: help of the option of each scope column
+def cache_cli(cache_class, description, default_path, column_help):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('command', choices=['stats', 'invalidate', 'prune'],
+                        help='show the number of entries, delete them, or delete those of the versions other than --version')
+    for column, text in column_help.items():
+        parser.add_argument('--' + column, default=None, help=text)
+    parser.add_argument('--cache', default=default_path, help='path of the cache database')
+    args = parser.parse_args()
+    conditions = {column: getattr(args, column) for column in column_help}
+    if args.command == 'prune' and args.version is None:
+        parser.error('prune needs the --version to keep')
+
+    cache = cache_class(args.cache)
+    if args.command == 'stats':
+        print('\t'.join([*cache_class.stats_columns, 'entries', *cache_class.stats_extra]))
+        for row in cache.stats(**conditions):
+            print('\t'.join(str(value) for value in row))
+    elif args.command == 'prune':
+        version = conditions.pop('version')
+        n = cache.prune(version, **conditions)
+        print(f'{n} entries of other versions deleted from {args.cache}')
+    else:
+        n = cache.invalidate(**conditions)
+        print(f'{n} entries deleted from {args.cache}')
+    cache.close()
+
+def main():
+    cache_cli(LexiconCache, 'Inspect, invalidate or prune the cross-release G2P lexicon cache', cache_path,
+              {'engine': 'G2P engine (epi, xpf, chr, mfa, cmn, nan)', 'lang': 'language code used by the engine', 'version': 'G2P version hash'})
+
+if __name__ == "__main__":
+    main()
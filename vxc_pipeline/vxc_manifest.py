@@ -0,0 +1,149 @@
+import os, re, json, time
+from collections.abc import Iterator
+
+# Clip manifest
+# The table of validated clips of a language (the speaker file: clips of the validated log minus the skiplisted speakers,
+# with durations and remapped speaker ids) is saved as Parquet in the language folder after it is built.
+# The manifest is keyed by the language, the Common Voice release, the size and modification time of the input files
+# (validated.tsv, clip_durations.tsv, speaker_skiplist.txt) and a hash of the code that builds it; as long as the key
+# matches, later runs (and later cells of the notebook) load the manifest instead of building the table again.
+# The speaker TSV is exported from the manifest.
+# The table can also be built as a sequence of chunks (see vxc_processing.build_validated_chunks): the chunks are then
+# appended to the manifest as they come, and the low-cardinality columns are loaded back as categoricals.
+# The table that is returned still has one row per clip, since the later steps need them all; to keep it small, only
+# the columns they use can be loaded (columns=...), and the speaker TSV is then exported from the manifest file one row
+# group at a time (export_speaker_file_chunks) instead of from the table.
+
+manifest_name = 'clip_manifest.parquet'
+
+##########################################################################################################
+##########################################################################################################
+
+# Size and modification time of the input files (None for missing files)
+def input_stamp(paths):
+    stamp = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stamp.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+        else:
+            stamp.append([os.path.basename(path), None, None])
+    return stamp
+
+# The release is the version in the name of the language folder (<lang_code>_v<release>, see vxc_setup.find_lang_dir)
+def folder_release(lang_dir):
+    match = re.search(r'_v([^_/\\]+)$', os.path.basename(os.path.normpath(lang_dir)))
+    return match.group(1) if match else None
+
+def manifest_key(lang_code, release, input_paths, version):
+    return json.dumps({'lang': lang_code, 'release': release, 'inputs': input_stamp(input_paths), 'version': version})
+
+# The manifest at path if it was built with the given key, None otherwise; columns: the columns to load (all if None)
+def load_manifest(path, key, columns=None):
+    import pyarrow.parquet as pq
+    if not os.path.exists(path):
+        return None
+    metadata = pq.read_schema(path).metadata or {}
+    if metadata.get(b'vxc_manifest_key', b'').decode('utf8') != key:
+        return None
+    categorical = json.loads(metadata.get(b'vxc_categorical', b'[]').decode('utf8'))
+    if columns is not None:
+        categorical = [column for column in categorical if column in columns]
+    return pq.read_table(path, columns=columns, read_dictionary=categorical).to_pandas()
+
+# Save the table with its key (to a temporary file first, so an interrupted write leaves no partial manifest)
+def save_manifest(df, path, key):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.Table.from_pandas(df)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'vxc_manifest_key': key.encode('utf8')})
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+# Save a table given as a sequence of dataframes, appending each one to the file as it comes.
+# The columns that are categorical in the chunks are written as strings and listed in the metadata, so that
+# load_manifest reads them as categoricals. Returns the number of rows.
+def save_manifest_chunks(chunks, path, key):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    writer = None
+    n_rows = 0
+    try:
+        for chunk in chunks:
+            if writer is None:
+                # The schema of the first chunk, with strings for all the non-numeric columns (a column can be empty in one chunk)
+                categorical = [column for column in chunk.columns if str(chunk[column].dtype) == 'category']
+                fields = [pa.field(column, pa.string()) if column in categorical or chunk[column].dtype == object
+                          else pa.field(column, pa.from_numpy_dtype(chunk[column].dtype)) for column in chunk.columns]
+                schema = pa.schema(fields, metadata={b'vxc_manifest_key': key.encode('utf8'),
+                                                     b'vxc_categorical': json.dumps(categorical).encode('utf8')})
+                writer = pq.ParquetWriter(tmp_path, schema)
+            chunk = chunk.astype({column: object for column in categorical})
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            n_rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError(f'No rows to write to {path}')
+    os.replace(tmp_path, path)
+    return n_rows
+
+# Load the manifest of a language folder, or build it with build() and save it.
+# build returns the table, or an iterator of chunks of the table (which needs pyarrow).
+# input_paths are the files the table is built from and version a hash of the code that builds it.
+# columns: the columns of the table to return (all if None); the manifest keeps all of them.
+def cached_manifest(lang_dir, lang_code, build, input_paths, version, release=None, columns=None):
+    path = os.path.join(lang_dir, manifest_name)
+    key = manifest_key(lang_code, release or folder_release(lang_dir), input_paths, version)
+    try:
+        start = time.time()
+        df = load_manifest(path, key, columns)
+        if df is not None:
+            print(f'Loaded the clip manifest {path} ({len(df)} clips) in {time.time() - start:.2f} seconds.')
+            return df
+    except ImportError:
+        built = build()
+        if isinstance(built, Iterator):
+            raise ImportError('pyarrow is needed to build the clip manifest in chunks')
+        print('pyarrow is not installed: the clip manifest is not used.')
+        return built if columns is None else built[columns]
+
+    built = build()
+    if isinstance(built, Iterator):
+        n_rows = save_manifest_chunks(built, path, key)
+        print(f'Saved the clip manifest to {path} ({n_rows} clips).')
+        return load_manifest(path, key, columns)
+
+    save_manifest(built, path, key)
+    print(f'Saved the clip manifest to {path} ({len(built)} clips).')
+    return built if columns is None else built[columns]
+
+# Whether the speaker file was already exported from the current manifest
+def speaker_file_current(spkr_file_path, lang_dir):
+    manifest_path = os.path.join(lang_dir, manifest_name)
+    return (os.path.exists(spkr_file_path) and os.path.exists(manifest_path)
+            and os.path.getmtime(spkr_file_path) >= os.path.getmtime(manifest_path))
+
+# Write the speaker file from the manifest, unless it was already exported from the current manifest
+def export_speaker_file(df, spkr_file_path, lang_dir):
+    if speaker_file_current(spkr_file_path, lang_dir):
+        return
+    if os.path.exists(spkr_file_path):
+        os.remove(spkr_file_path)
+    df.to_csv(spkr_file_path, sep='\t', index=False)
+
+# Same as export_speaker_file, but the rows are read from the manifest file one row group at a time (for the chunked build),
+# so the whole table (with the columns the returned table leaves out) is never in memory
+def export_speaker_file_chunks(spkr_file_path, lang_dir):
+    import pyarrow.parquet as pq
+    if speaker_file_current(spkr_file_path, lang_dir):
+        return
+    tmp_path = f'{spkr_file_path}.{os.getpid()}.tmp'
+    manifest = pq.ParquetFile(os.path.join(lang_dir, manifest_name))
+    with open(tmp_path, 'w', newline='') as spkr_file:
+        for i in range(manifest.num_row_groups):
+            manifest.read_row_group(i).to_pandas().to_csv(spkr_file, sep='\t', index=False, header=(i == 0))
+    os.replace(tmp_path, spkr_file_path)
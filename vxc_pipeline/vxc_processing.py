@@ -1,11 +1,31 @@
-import re, csv, subprocess, os, shutil
+import re, csv, subprocess, os, shutil, sys
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 from praatio import textgrid
 from pathlib import Path
 
-# Tokenize IPA
-from lingpy import ipa2tokens
+# Tokenize and sanitize IPA (same output as lingpy's ipa2tokens, memoized)
+from vxc_ipa import segment_ipa, clean_ipa, sanitize_ipa, filter_ipa_symbols, ipa_version
+
+# Cross-release G2P cache
+from vxc_lexicon_cache import cached_g2p, g2p_version, package_version, file_hash
+
+# Client of the warm G2P service (vxc_g2p_service.py)
+from vxc_g2p_service import service_g2p, service_load, G2PServiceError
+
+# Common G2P backend interface (vxc_g2p_backends.py)
+from vxc_g2p_backends import G2PBackend
+
+# Cached clip manifest of a language folder (vxc_manifest.py)
+from vxc_manifest import cached_manifest, export_speaker_file, export_speaker_file_chunks, manifest_name
+
+# Speaker ids kept from the previous release (vxc_delta.py)
+from vxc_delta import carry_build, carry_speaker_ids
+
+# Compact clip table with the clip paths derived on demand (vxc_clips.py)
+from vxc_clips import compact_clips, iter_clip_paths
 
 ##########################################################################################################
 ##########################################################################################################
@@ -28,9 +48,8 @@ def read_in_log(path):
                           })
     return df
 
-# Remap speakers and generate a speaker file
-def remap_spkr(lang_dir, spkr_file_path, lang_code, output=True):
-    clip_dir = os.path.join(lang_dir, 'clips') # Where all the clips are
+# Build the table of validated clips with remapped speakers (the content of the speaker file)
+def build_validated(lang_dir, lang_code):
     valid_log = os.path.join(lang_dir, 'validated.tsv') # where the validated utterance log of common voice is
     clip_dur_file = os.path.join(lang_dir, 'clip_durations.tsv') # where the clip duration file is
 
@@ -77,33 +96,118 @@ def remap_spkr(lang_dir, spkr_file_path, lang_code, output=True):
     
     # Normalize the apostrophe in Uzbek
     if lang_code == 'uz':
-        # Replace the apostrophes after o and g with a simple '
-        transcript = validated['sentence'].tolist()
-        transcript = [re.sub(r"([oOgG])([ʼ‘’ʻ`'´])", r"\1ʻ", sentence) for sentence in transcript]
-        transcript = [re.sub(r"([^\W\d_ogOG])([ʼ‘’ʻ`'´])", r"\1ʼ", sentence) for sentence in transcript]
-        transcript = [re.sub(r"(-|•)", " ", sentence) for sentence in transcript]
-        validated['sentence'] = transcript
-        
-    # save the speaker file
-    if output:
-        if os.path.exists(spkr_file_path):
-            os.remove(spkr_file_path)
-        validated.to_csv(spkr_file_path, sep='\t', index=False)
-
-    # The file paths
-    paths = validated['path'].tolist()
-    validated['src_path'] = [os.path.join(clip_dir, path) for path in paths]
-    validated['new_path'] = [os.path.join(lang_dir, 'validated', path) for path in paths]
-    
-    # If there are more than 32000 files, split them into groups and create paths in the subfolders
-    if len(validated) > 32000:
-        root = os.path.join(lang_dir, 'validated')
-        num_groups = (len(validated) + 32000 - 1) // 32000
-        validated['subfolder'] = ["subfolder_" + str(i+1).zfill(3) for i in range(num_groups) for _ in range(min(32000, len(validated) - i*32000))]
-        validated['sub_path'] = [os.path.join(root, i, j) for i, j in zip(validated.subfolder, validated.path)]
+        validated = normalize_uz(validated)
 
     return validated
 
+def normalize_uz(validated):
+    # Replace the apostrophes after o and g with a simple '
+    transcript = validated['sentence'].tolist()
+    transcript = [re.sub(r"([oOgG])([ʼ‘’ʻ`'´])", r"\1ʻ", sentence) for sentence in transcript]
+    transcript = [re.sub(r"([^\W\d_ogOG])([ʼ‘’ʻ`'´])", r"\1ʼ", sentence) for sentence in transcript]
+    transcript = [re.sub(r"(-|•)", " ", sentence) for sentence in transcript]
+    validated['sentence'] = transcript
+    return validated
+
+# Chunked version of build_validated for the very large locales (English, Catalan, ...)
+# validated.tsv is read in blocks by pyarrow's streaming CSV reader, with the low-cardinality columns as categoricals,
+# and each block is filtered, joined with the durations and given speaker ids on its own. Only the durations
+# and the client_id -> speaker_id map are kept across the blocks. The speaker ids are the same as with build_validated
+# (numbered in order of appearance, including the speakers whose clips are all too short).
+# Yields the chunks of the table, which cached_manifest appends to the manifest.
+
+# Columns of validated.tsv with few distinct values
+log_categorical = ['client_id', 'age', 'gender', 'accents', 'accentes', 'variant', 'locale', 'segment', 'sentence_domain']
+
+# Read validated.tsv in blocks of about block_size bytes, with the types of read_in_log except for the categoricals
+def read_in_log_chunks(path, block_size=64 << 20):
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+    with open(path, 'r', encoding='utf8') as log:
+        columns = log.readline().rstrip('\n').split('\t')
+    column_types = {column: pa.int16() if column in ['up_votes', 'down_votes']
+                    else pa.dictionary(pa.int32(), pa.string()) if column in log_categorical
+                    else pa.string() for column in columns}
+    reader = pa_csv.open_csv(path, read_options=pa_csv.ReadOptions(block_size=block_size),
+                             parse_options=pa_csv.ParseOptions(delimiter='\t', quote_char=False),
+                             convert_options=pa_csv.ConvertOptions(column_types=column_types, strings_can_be_null=True))
+    for batch in reader:
+        yield batch.to_pandas()
+
+def build_validated_chunks(lang_dir, lang_code, block_size=64 << 20):
+    valid_log = os.path.join(lang_dir, 'validated.tsv') # where the validated utterance log of common voice is
+    clip_dur_file = os.path.join(lang_dir, 'clip_durations.tsv') # where the clip duration file is
+
+    # Skip the clients whose data are deleted on Common Voice
+    with open('speaker_skiplist.txt', 'r') as skip:
+        speaker_skiplist = set(line.strip() for line in skip.readlines()) # get the client ids that need to be skipped
+
+    # Clip durations in seconds, by clip name
+    clip_dur = pd.read_csv(clip_dur_file, sep = '\t', dtype = {'clip': 'str', 'duration[ms]': 'float64'})
+    clip_dur = pd.Series(clip_dur['duration[ms]'].to_numpy() / 1000, index = clip_dur['clip'])
+
+    speaker_ids = {}
+    for chunk in read_in_log_chunks(valid_log, block_size):
+        chunk = chunk[~chunk['client_id'].isin(speaker_skiplist)]
+
+        # Keep the clips with a duration, with the path first as in build_validated
+        chunk = chunk[chunk['path'].isin(clip_dur.index)]
+        chunk = chunk[['path'] + [column for column in chunk.columns if column != 'path']]
+        chunk['dur'] = clip_dur.loc[chunk['path']].to_numpy()
+
+        # remap the speakers: new speakers get the next ids
+        for client_id in chunk['client_id'].unique():
+            if client_id not in speaker_ids:
+                speaker_ids[client_id] = str(len(speaker_ids) + 1)
+        chunk['speaker_id'] = chunk['client_id'].map(speaker_ids)
+
+        # subset the data to only validated recordings (the clips longer than one second)
+        chunk = chunk[chunk['dur'] > 1]
+
+        # Normalize the apostrophe in Uzbek
+        if lang_code == 'uz':
+            chunk = normalize_uz(chunk)
+
+        if len(chunk) > 0:
+            yield chunk
+
+# The columns of the clip table the later steps use (clip paths, TextGrids, G2P word list, release delta):
+# with the chunked build, only these are loaded back from the manifest
+clip_columns = ['path', 'client_id', 'sentence', 'dur', 'speaker_id']
+
+# The files build_validated reads
+def validated_inputs(lang_dir):
+    return [os.path.join(lang_dir, 'validated.tsv'), os.path.join(lang_dir, 'clip_durations.tsv'), 'speaker_skiplist.txt']
+
+# Remap speakers and generate a speaker file
+# The table is loaded from the clip manifest of the language folder if its inputs did not change since it was built.
+# With chunked=True, validated.tsv is processed in blocks of block_size bytes (see build_validated_chunks; needs pyarrow),
+# the speaker file is written from the manifest one row group at a time, and only the clip_columns are returned.
+# The returned table still has one row per clip (5 columns instead of 15), as do the clip durations kept during the build,
+# so the peak memory still grows with the locale, only more slowly.
+# With the folder of a previous processed release as previous_dir, the speakers keep their speaker ids of that release (see vxc_delta.py).
+def remap_spkr(lang_dir, spkr_file_path, lang_code, output=True, release=None, chunked=False, block_size=64 << 20, previous_dir=None):
+    if chunked:
+        build = lambda: build_validated_chunks(lang_dir, lang_code, block_size)
+        version = g2p_version(read_in_log_chunks, build_validated_chunks, normalize_uz, log_categorical)
+    else:
+        build = lambda: build_validated(lang_dir, lang_code)
+        version = g2p_version(read_in_log, build_validated, normalize_uz)
+    inputs = validated_inputs(lang_dir)
+    if previous_dir is not None:
+        build = carry_build(build, previous_dir)
+        version = g2p_version(version, carry_build, carry_speaker_ids)
+        inputs.append(os.path.join(previous_dir, manifest_name))
+    validated = cached_manifest(lang_dir, lang_code, build, inputs, version, release, clip_columns if chunked else None)
+
+    # save the speaker file
+    if output and chunked:
+        export_speaker_file_chunks(spkr_file_path, lang_dir)
+    elif output:
+        export_speaker_file(validated, spkr_file_path, lang_dir)
+
+    return compact_clips(validated, lang_dir)
+
 # Detect if the orthography is in Cyrillic or not:
 def contains_cyrillic(text):
     return any('\u0400' <= c <= '\u04FF' or '\u0500' <= c <= '\u052F' or '\u2DE0' <= c <= '\u2DFF' or '\uA640' <= c <= '\uA69F' for c in text)
@@ -129,7 +233,7 @@ def create_textgrid(snd_file, dur, speaker_id, transcript):
     tg.save(tg_filename, format='short_textgrid', includeBlankSpaces=True)
 
 def move_and_create_tg(df):
-    for src_mp3_path, new_path, speaker, dur, transcript in zip(df.src_path, df.new_path, df.speaker_id, df.dur, df.sentence):
+    for src_mp3_path, new_path, speaker, dur, transcript in zip(iter_clip_paths(df, 'src'), iter_clip_paths(df, 'new'), df.speaker_id, df.dur, df.sentence):
         src_mp3_path = Path(src_mp3_path)
         new_path = Path(new_path)
         # Copy sound file and crate the textgrid file  
@@ -141,7 +245,7 @@ def move_and_create_tg(df):
             # Get the textgrid file name
             tg_filename = new_path.with_suffix('.TextGrid')
             if not os.path.exists(tg_filename):
-                create_textgrid(new_path, dur, speaker, transcript)
+                create_textgrid(new_path, dur, str(speaker), transcript)
     
 
 
@@ -210,94 +314,239 @@ def process_words(df, lang_code, is_cjk):
 # G2P
 
 # Epitran
-ipa_symbols = re.compile(r'[ẽ\u0020-\u007E\u00A0-\u00FF\u0100-\u017F\u0180-\u024F\u0250-\u02AF\u02B0-\u02FF\u0300-\u036F\u0370-\u03FF\u1AB0-\u1AFF\u1DC0-\u1DFF\u2000-\u206F\u2070-\u209F\u2190-\u21FF\u2C60-\u2C7F\uA700-\uA71F\u0300-\u036F]+|\s')
-
-def filter_ipa_symbols(input_string):
-    filtered_string = ''.join(char for char in input_string if ipa_symbols.match(char))
-
-    return filtered_string if len(filtered_string) == len(input_string) else ''
-
-def epi_g2p(words, epi_code, dict_file_path):
-    import epitran
+# The IPA sanitizer (clean_ipa, sanitize_ipa, filter_ipa_symbols) is in vxc_ipa.py
+
+# Tamil: the aytham (ஃ) before a consonant makes a sound that is not in Epitran
+tam_sub = {
+    'ஃ p': 'f',
+    'ஃ t̪': 'tˤ',
+    'ஃ k': 'x',
+    'ஃ s': 'k s',
+    'ஃ ʋ': 'w',
+    'ஃ ʂ': 'sˤ',
+    'ஃ d͡ʒ': 'z',
+    'ஃ r': 'ɹ̥'
+}
+def sub_tam(match):
+    return tam_sub[match.group(0)]
+
+# Language-specific fixes of the Epitran output, keyed by the Epitran code.
+# The 'pre' rewrites apply right after IPA tokenization, the 'post' ones after identical IPA symbols are separated.
+epi_rewrites = {
+    'tam-Taml': {'pre': [('|'.join(map(re.escape, tam_sub.keys())), sub_tam)]},
+    'kmr-Latn': {'post': [('a', 'ɑ')]}, # Kurmanji Kurdish low vowel is /ɑ/
+    'mar-Deva': {'post': [('ऑ', 'ɔ'), # ऑ is ɔ in Marathi
+                          ('ऍ', 'ɛ'),
+                          ('ॲ', 'æ')]},
+    'tha-Thai': {'post': [('ː([iɯueɤoɛaɔ]+ː)', 'ː \1')]},
+    'ori-Orya': {'post': [(' ଃ', 'h')]}
+}
+
+# Rewrites shared by all languages
+ipa_pair = re.compile(r'([\u0020-\u007E\u00A0-\u00FF\u0100-\u017F\u0180-\u024F\u0250-\u02AF\u02B0-\u02FF\u0300-\u036F\u0370-\u03FF])\1')
+stress_marks = re.compile(r'ˈ|ˌ')
+spaces = re.compile('[ ]+')
+
+# Build the post-processing pipeline of a language once: it turns the Epitran output of a word into the phone,
+# which is then cleaned of non-IPA symbols by epi_postproc
+@lru_cache(maxsize=None)
+def epi_pipeline(epi_code):
+    rewrites = epi_rewrites.get(epi_code, {})
+    pre = [(re.compile(pattern), repl) for pattern, repl in rewrites.get('pre', [])]
+    post = [(re.compile(pattern), repl) for pattern, repl in rewrites.get('post', [])]
+
+    def pipeline(phone):
+        phone = phone.replace(':', 'ː')
+        # Separate the IPAs with white spaces
+        if len(phone) > 0:
+            phone = segment_ipa(phone)
+        for pattern, repl in pre:
+            phone = pattern.sub(repl, phone)
+        # Separate any identical ipa symbols repeated twice with a white space
+        phone = ipa_pair.sub(r'\1 \1', phone)
+        for pattern, repl in post:
+            phone = pattern.sub(repl, phone)
+        phone = stress_marks.sub('', phone) # strip the stress markers
 
-    epi = epitran.Epitran(epi_code)
+        phone = phone.replace("'", ' ')
+        phone = spaces.sub(' ', phone)
+        return phone
 
-    lex_dict = {}
-    for word in words:
-        # Conversion
-        phone = epi.transliterate(word)
-        phone = re.sub(":", "ː", phone)
-        if len(phone) > 0:
-        # Separate the IPAs with white spaces
-            phone = ' '.join(ipa2tokens(phone))
-
-        if epi_code == 'tam-Taml':
-            tam_sub = {
-                'ஃ p': 'f',
-                'ஃ t̪': 'tˤ',
-                'ஃ k': 'x',
-                'ஃ s': 'k s',
-                'ஃ ʋ': 'w',
-                'ஃ ʂ': 'sˤ',
-                'ஃ d͡ʒ': 'z',
-                'ஃ r': 'ɹ̥'
-            }
-            pattern = re.compile('|'.join(map(re.escape, tam_sub.keys())))
-            def sub_tam(match):
-                return tam_sub[match.group(0)]
-            phone = pattern.sub(sub_tam, phone)
+    return pipeline
 
-        # Separate any identical ipa symbols repeated twice with a white space
-        phone = re.sub(r'([\u0020-\u007E\u00A0-\u00FF\u0100-\u017F\u0180-\u024F\u0250-\u02AF\u02B0-\u02FF\u0300-\u036F\u0370-\u03FF])\1', r'\1 \1', phone)
-
-        if epi_code == 'kmr-Latn':
-            phone = re.sub('a', 'ɑ', phone) # Kurmanji Kurdish low vowel is /ɑ/
-        elif epi_code == 'mar-Deva':
-            phone = re.sub('ऑ', 'ɔ', phone) # ऑ is ɔ in Marathi
-            phone = re.sub('ऍ', 'ɛ', phone)
-            phone = re.sub('ॲ', 'æ', phone)
-        elif epi_code == 'tha-Thai':
-            phone = re.sub('ː([iɯueɤoɛaɔ]+ː)', 'ː \1', phone)
-        elif epi_code == 'ori-Orya':
-            phone = re.sub(' ଃ', 'h', phone)
-        
-        phone = re.sub(r'ˈ|ˌ', '', phone) # strip the stress markers
+# Post-process the Epitran output of a whole word list
+def epi_postproc(phones, epi_code):
+    pipeline = epi_pipeline(epi_code)
+    phones = [pipeline(phone) for phone in phones]
+    # Get rid of the non-IPAs from the output
+    clean_phones, _ = sanitize_ipa(phones, collapse_spaces=True)
+    return list(zip(phones, clean_phones))
 
-        # Get rid of the non-IPAs from the output
-        phone = re.sub("'", ' ', phone)
-        phone = re.sub('[ ]+', ' ', phone)
-        only_ipa = re.findall(ipa_symbols, phone)
-        clean_phone = ' '.join(only_ipa)
-        clean_phone = re.sub('\s+', ' ', clean_phone)
+# Epitran run by a G2P worker: the Epitran instance is created once per worker process by epi_init
+epi_worker = {}
 
-        lex_dict[word] = clean_phone
-        if phone != clean_phone:
-            print(word + ': ' + phone + '\t' + clean_phone)
+def epi_init(epi_code, convert):
+    import epitran
+    epi_worker['epi'] = epitran.Epitran(epi_code)
+    epi_worker['epi_code'] = epi_code
+    epi_worker['convert'] = convert
+
+def epi_chunk(words):
+    return epi_worker['convert'](epi_worker['epi'], words, epi_worker['epi_code'])
+
+# Run an Epitran conversion over the word list, on n_jobs worker processes if n_jobs > 1.
+# convert(epi, words, epi_code) returns a (word, phone, clean_phone) triple for each word; it must be a module-level function.
+def epi_transliterate(words, epi_code, convert, n_jobs=1, chunksize=1000):
+    if n_jobs <= 1:
+        epi_init(epi_code, convert)
+        return epi_chunk(words)
+
+    chunks = [words[i:i+chunksize] for i in range(0, len(words), chunksize)]
+    with ProcessPoolExecutor(n_jobs, initializer=epi_init, initargs=(epi_code, convert)) as executor:
+        return [triple for triples in executor.map(epi_chunk, chunks) for triple in triples]
+
+# Report the words whose pronunciation had non-IPA symbols removed
+def report_g2p_diffs(triples):
+    diffs = [(word, phone, clean_phone) for word, phone, clean_phone in triples if phone != clean_phone]
+    if len(diffs) > 0:
+        print(f'Non-IPA symbols were removed from {len(diffs)} of {len(triples)} pronunciations:')
+    for word, phone, clean_phone in diffs:
+        print(word + ': ' + phone + '\t' + clean_phone)
+
+def epi_convert(epi, words, epi_code):
+    # Conversion
+    phones = [epi.transliterate(word) for word in words]
+    return [(word, phone, clean_phone) for word, (phone, clean_phone) in zip(words, epi_postproc(phones, epi_code))]
+
+# Everything that can change the Epitran lexicon of a language (for the G2P cache)
+def epi_version(epi_code):
+    return g2p_version(package_version('epitran'), ipa_version(), epi_code,
+                       epi_rewrites.get(epi_code, {}), tam_sub, epi_pipeline, epi_postproc, epi_convert)
+
+# service: socket path of a running G2P service to convert the words with, instead of loading Epitran here
+# (the cache entries are then keyed by the version of the code the service runs)
+def epi_g2p(words, epi_code, dict_file_path, n_jobs=1, cache=None, service=None):
+    version = service_load('epi', epi_code, path=service) if service is not None else epi_version(epi_code)
+
+    def convert(new_words):
+        if service is not None:
+            triples = service_g2p('epi', epi_code, new_words, path=service)
+        else:
+            triples = epi_transliterate(new_words, epi_code, epi_convert, n_jobs)
+        report_g2p_diffs(triples)
+        return [(word, clean_phone) for word, phone, clean_phone in triples]
+
+    # Only the words that are not in the G2P cache (if any) are converted
+    lex_dict = cached_g2p(words, convert, 'epi', version, epi_code, cache)
 
     # write to outfile
     with open(dict_file_path, 'w') as dict_file:
         for word, phone in sorted(lex_dict.items()):
-            if phone.strip() != '': 
+            if phone is not None and phone.strip() != '': 
                 dict_file.write(word + '\t' + phone + "\n")
 
-    
-# XPF
-def xpf_g2p(xpf_translater_path, rule_file_path, verify_file_path, word_file_path, dict_file_path):
-    g2p_cmd = ["python", xpf_translater_path, "-l", rule_file_path, "-c", verify_file_path, "-r", word_file_path] # XPF translating command that will be sent to subprocess.run() to execute.
 
-    with open(dict_file_path,'w') as dict_file:
-        subprocess.run(g2p_cmd, stdout = dict_file) # stdout = ... means to send the output to the file (so you have to open this file first as above)
+class EpiBackend(G2PBackend):
+    engine = 'epi'
+    load_cost = 2.0
+    word_cost = 2e-4
 
-    # This is to get rid of all the '@' in the lexicon (if there is any). @ means that XPF G2P failure
-    with open(dict_file_path, "r") as dict_file:
-        dict = dict_file.read().split("\n")
+    def load(self):
+        import epitran
+        self.loaded = epitran.Epitran(self.lang)
+
+    def version(self):
+        return epi_version(self.lang)
+
+    def convert(self, words):
+        triples = epi_convert(self.loaded, words, self.lang)
+        report_g2p_diffs(triples)
+        return [(word, clean_phone) for word, phone, clean_phone in triples]
+
+# XPF
+# Everything that can change the XPF lexicon of a language (for the G2P cache)
+# The whole translator module is hashed: the rule matching is spread over its classes (subrule, positional, alphabet2ipa)
+def xpf_version(rule_file_path):
+    import xpf_translate04
+    return g2p_version(file_hash(rule_file_path), file_hash(xpf_translate04.__file__))
+
+# A failed verification is reported on stderr and leaves an empty lexicon, as when the translator was run as a script
+def xpf_failed(message, dict_file_path):
+    print(message, file=sys.stderr)
+    open(dict_file_path, 'w').close()
+
+# service: socket path of a running G2P service that keeps the rules loaded between runs
+def xpf_g2p(words, rule_file_path, verify_file_path, dict_file_path, n_jobs=1, cache=None, service=None):
+    from xpf_translate04 import load, CACHE_DIR
+
+    # Load the XPF rules and check them against the verification file (both reused from the cache if the files are unchanged)
+    if service is not None:
+        options = {'verify_file_path': os.path.abspath(verify_file_path)}
+        rule_file_path = os.path.abspath(rule_file_path)
+        try:
+            # The version of the rules the service has loaded (it loads them again if the files changed)
+            version = service_load('xpf', rule_file_path, options, path=service)
+        except G2PServiceError as e:
+            xpf_failed(str(e), dict_file_path)
+            return
+        translate = lambda new_words: service_g2p('xpf', rule_file_path, new_words, options, path=service)
+    else:
+        with open(rule_file_path, 'r', encoding='utf8') as rule_file, open(verify_file_path, 'r', encoding='utf8') as verify_file:
+            a2ipa, verified = load(rule_file, verify_file, cachedir=CACHE_DIR)
+        if not verified:
+            xpf_failed('Verification failed, not processing additional data', dict_file_path)
+            return
+        translate = lambda new_words: list(a2ipa.translate_many(new_words, jobs=n_jobs))
+        version = xpf_version(rule_file_path)
+
+    # Only the words that are not in the G2P cache (if any) are translated, on n_jobs processes if n_jobs > 1.
+    # The cache entries depend on the rules file and the translator code.
+    lang = os.path.splitext(os.path.basename(rule_file_path))[0]
+    lex_dict = cached_g2p(words, translate, 'xpf', version, lang, cache)
+
+    # Words with sounds XPF can't figure out ('@' in the translation) are left out of the lexicon.
+    with open(dict_file_path, 'w') as dict_file:
+        for word in words:
+            phone = lex_dict[word]
+            if phone is not None:
+                dict_file.write(word + '\t' + phone + '\n')
+
+# lang is the name of the rules file (e.g. 'tr' for tr.rules), as in the G2P cache
+class XPFBackend(G2PBackend):
+    engine = 'xpf'
+    load_cost = 0.5
+    word_cost = 5e-4
+
+    def __init__(self, rule_file_path, verify_file_path):
+        super().__init__(os.path.splitext(os.path.basename(rule_file_path))[0])
+        self.rule_file_path = rule_file_path
+        self.verify_file_path = verify_file_path
+
+    def load(self):
+        from xpf_translate04 import load, CACHE_DIR
+        with open(self.rule_file_path, 'r', encoding='utf8') as rule_file, open(self.verify_file_path, 'r', encoding='utf8') as verify_file:
+            a2ipa, verified = load(rule_file, verify_file, cachedir=CACHE_DIR)
+        if not verified:
+            raise ValueError(f'Verification of {self.rule_file_path} failed')
+        self.loaded = a2ipa
+
+    def version(self):
+        return xpf_version(self.rule_file_path)
+
+    def convert(self, words):
+        return self.loaded.translate_many(words)
+
+# Charsiu through the G2P service, so the model is loaded once for all languages (instead of running chr_g2p.py for each)
+def chr_g2p(words, code_chr, dict_file_path, service, token_budget=4096, cache=None):
+    options = {'token_budget': token_budget}
+    version = service_load('chr', code_chr, options, path=service)
+    lex_dict = cached_g2p(words, lambda new_words: service_g2p('chr', code_chr, new_words, options, path=service), 'chr', version, code_chr, cache)
 
     with open(dict_file_path, 'w') as dict_file:
-        for i in dict:
-            i = re.sub(" ː", "ː", i)
-            # Get rid of words that contain sounds XPF can't figure out
-            if '@' not in i:
-                dict_file.write(i + "\n")
+        for word in words:
+            phone = lex_dict[word]
+            if phone is not None:
+                dict_file.write(word + '\t' + phone + '\n')
 
 ##########################################################################################################
 ##########################################################################################################
@@ -305,7 +554,7 @@ def xpf_g2p(xpf_translater_path, rule_file_path, verify_file_path, word_file_pat
 # Move the recordings in and out of subfolders when the corpus is too large (more than 32000 recordings)
 def split_recs(df):
     df = df
-    for src_snd, sub_snd in zip(df.new_path, df.sub_path):
+    for src_snd, sub_snd in zip(iter_clip_paths(df, 'new'), iter_clip_paths(df, 'sub')):
         src_tg = Path(src_snd).with_suffix('.TextGrid')
         sub_tg = Path(sub_snd).with_suffix('.TextGrid')
         try:
@@ -317,7 +566,7 @@ def split_recs(df):
 # Merge the recordings back
 def merge_recs(df):
     df = df
-    for src_snd, sub_snd in zip(df.sub_path, df.new_path):
+    for src_snd, sub_snd in zip(iter_clip_paths(df, 'sub'), iter_clip_paths(df, 'new')):
         src_tg = Path(src_snd).with_suffix('.TextGrid')
         sub_tg = Path(sub_snd).with_suffix('.TextGrid')
         try:
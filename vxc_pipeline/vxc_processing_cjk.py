@@ -1,33 +1,31 @@
-import re, csv, os, shutil, epitran, subprocess
+import re, csv, os, shutil, subprocess, time
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 from praatio import textgrid
 from pathlib import Path
 
-# Japanese tokenizer
-from fugashi import Tagger
-import pykakasi
-# Korean tokenizer
-#from konlpy.tag import Okt
-# Cantonese tokenizer
-import pycantonese
-# Traditional Chinese tokenizer
-from ckiptagger import WS
-# Simplified Chinese tokenizer and processing
-import pkuseg
-import chinese_converter
-# For Chinese G2P
-from pypinyin import pinyin, Style
-from pinyin_to_ipa import pinyin_to_ipa
-# Taiwanese Southern Min
-import taibun
-# Korean G2P
-from g2pk2 import G2p
-# Thai Tokenizer
-from pythainlp import word_tokenize
+# The tokenizers and G2P packages of the different languages (fugashi, pykakasi, pycantonese, ckiptagger, pkuseg,
+# chinese_converter, pypinyin, pinyin_to_ipa, taibun, g2pk2, pythainlp, epitran) are slow to import,
+# so each one is imported in the function that uses it: a run only loads the ones its language needs.
+
+# Tokenize and sanitize IPA (same output as lingpy's ipa2tokens, memoized)
+from vxc_ipa import segment_ipa, clean_ipa, filter_ipa_symbols, ipa_version
 
-# Tokenize IPA
-from lingpy import ipa2tokens
+# Epitran worker processes
+from vxc_processing import epi_transliterate, report_g2p_diffs, epi_version, EpiBackend
+# Clip manifest and compact clip table shared with the other languages
+from vxc_processing import validated_inputs, xpf_failed
+from vxc_manifest import cached_manifest, export_speaker_file, manifest_name
+from vxc_clips import compact_clips, iter_clip_paths
+from vxc_delta import carry_build, carry_speaker_ids
+# Cross-release G2P cache
+from vxc_lexicon_cache import cached_g2p, g2p_version, package_version
+# Cross-release sentence tokenization cache
+from vxc_sentence_cache import cached_tokenize
+
+# Common G2P backend interface
+from vxc_g2p_backends import G2PBackend
 
 ##################################################################################################
 ##################################################################################################
@@ -36,6 +34,7 @@ from lingpy import ipa2tokens
 # Convert between simplified Chinese and traditional Chinese
 def convert_chn(df, lang_code):
     if lang_code in ['zh-CH', 'yue', 'zh-HK', 'zh-TW', 'nan-tw']:
+        import chinese_converter
         if lang_code == 'zh-CN':
             converted = [chinese_converter.to_simplified(text) for text in df['sentence'].astype('str').tolist()]
             df['sentence'] = converted
@@ -44,59 +43,131 @@ def convert_chn(df, lang_code):
             df['sentence'] = converted
     return df
 
-def tok_cjk(df, lang_code):
-    sentences = df['sentence'].astype('str').tolist()
-
+# Japanese text post processing: putting the phonological words together as much as possible
+jpn_part = re.compile(r' (た|だ|が|の|を|に|へ|と|から|より|で|のに|や|し|やら|か|なり|だの|ばかり|まで|だけ|ほど|くらい|ぐらい|など|なり|やら|がてら|なぞ|なんぞ|かり|ずつ|のみ|きり|は|も|こそ|でも|しか|さえ|ば|ても|でも|けど|けれど|けれども|のに|ので|から|し|して|て|なり|ながら|ては|ても|たり|つつ|ところで|まま|ものの|か|な|とも|ぞ|ぜ|かい|よ|ね|さ|やら|ものか|わ|もの|かしら|ってば|って|さ|よ|ね|な|なあ|でき|的な|的に|的だ|的で|ください)($| )')
+
+def jpn_postproc(text):
+    text = re.sub(r'([っッ]) ', r'\1', text)
+    text = re.sub(r'([んン]) ', r'\1', text)
+    text = re.sub(r'[ ]*(ん)[ ]*', r'\1', text)
+    text = re.sub(r' し (て|た)', r'し\1', text)
+    text = re.sub(jpn_part, r'\1\2', text)
+    text = re.sub(r' (派|所|達|語|的|町|県|市|町|区|村|州|学|て|方|機)', r'\1', text)
+    text = re.sub(r'(何|一|二|三|四|五|六|七|八|九|十) (年|月|日|回|階)', r'\1\2', text)
+    text = re.sub(r' (新) ', r' \1', text)
+    return text
+
+# Create the tokenizer of a language: returns a function that takes a list of sentences and returns the tokenized sentences
+def make_tokenizer(lang_code):
     if lang_code == 'ja':
-        wakati = Tagger('-Owakati')    
-        tokenized = [re.sub(r'[,。、「」\[\]\%\(\)（）・？!]+', ' ', text) for text in sentences]
-        tokenized = [re.sub(r'[a-zA-Z\d\s\W]+', ' ', text) for text in tokenized]
-        tokenized = [wakati.parse(sentence) for sentence in tokenized]
-        # Japanse text post processing: putting the phonological words together as much as possible
-        tokenized = [re.sub(r'([っッ]) ', r'\1', text) for text in tokenized]
-        tokenized = [re.sub(r'([んン]) ', r'\1', text) for text in tokenized]
-        tokenized = [re.sub(r'[ ]*(ん)[ ]*', r'\1', text) for text in tokenized]
-        tokenized = [re.sub(r' し (て|た)', r'し\1', text) for text in tokenized]
-        jpn_part = re.compile(r' (た|だ|が|の|を|に|へ|と|から|より|で|のに|や|し|やら|か|なり|だの|ばかり|まで|だけ|ほど|くらい|ぐらい|など|なり|やら|がてら|なぞ|なんぞ|かり|ずつ|のみ|きり|は|も|こそ|でも|しか|さえ|ば|ても|でも|けど|けれど|けれども|のに|ので|から|し|して|て|なり|ながら|ては|ても|たり|つつ|ところで|まま|ものの|か|な|とも|ぞ|ぜ|かい|よ|ね|さ|やら|ものか|わ|もの|かしら|ってば|って|さ|よ|ね|な|なあ|でき|的な|的に|的だ|的で|ください)($| )')
-        tokenized = [re.sub(jpn_part, r'\1\2', text) for text in tokenized]
-        tokenized = [re.sub(r' (派|所|達|語|的|町|県|市|町|区|村|州|学|て|方|機)', r'\1', text) for text in tokenized]
-        tokenized = [re.sub(r'(何|一|二|三|四|五|六|七|八|九|十) (年|月|日|回|階)', r'\1\2', text) for text in tokenized]
-        tokenized = [re.sub(r' (新) ', r' \1', text) for text in tokenized]
+        # Japanese tokenizer
+        from fugashi import Tagger
+        wakati = Tagger('-Owakati')
+        def tokenize(sentences):
+            tokenized = [re.sub(r'[,。、「」\[\]\%\(\)（）・？!]+', ' ', text) for text in sentences]
+            tokenized = [re.sub(r'[a-zA-Z\d\s\W]+', ' ', text) for text in tokenized]
+            return [jpn_postproc(wakati.parse(sentence)) for sentence in tokenized]
 
     # Cantonese
     elif lang_code in ['yue', 'zh-HK']:
-        tokenized = [' '.join(pycantonese.segment(sentence)) for sentence in sentences]
-    
+        import pycantonese
+        def tokenize(sentences):
+            return [' '.join(pycantonese.segment(sentence)) for sentence in sentences]
+
     # Simplified Chinese
     elif lang_code == 'zh-CN':
+        import pkuseg
         seg = pkuseg.pkuseg()
-        tokenized = [' '.join(seg.cut(sentence)) for sentence in sentences]
-        tokenized = [re.sub('[·•]', ' ', sentence) for sentence in tokenized]
-    
+        def tokenize(sentences):
+            tokenized = [' '.join(seg.cut(sentence)) for sentence in sentences]
+            return [re.sub('[·•]', ' ', sentence) for sentence in tokenized]
+
     # Traditional Chinese
     elif lang_code == 'zh-TW':
+        from ckiptagger import WS
         ws = WS("./ckiptagger_data")
-        tokenized = ws(sentences)
-        tokenized = [' '.join(item) for item in tokenized]
-    
+        def tokenize(sentences):
+            return [' '.join(item) for item in ws(sentences)]
+
     elif lang_code == 'nan-tw':
+        import taibun
         t = taibun.Tokeniser()
-        sentences = df['sentence'].str.replace(r'[^\u4e00-\u9fff\u3400-\u4dbf\uf900-\ufaff]', '', regex = True).tolist()
-        tokenized = [' '.join(t.tokenise(sent)) for sent in sentences]
+        def tokenize(sentences):
+            sentences = [re.sub(r'[^\u4e00-\u9fff\u3400-\u4dbf\uf900-\ufaff]', '', sent) for sent in sentences]
+            return [' '.join(t.tokenise(sent)) for sent in sentences]
 
     elif lang_code == 'th':
-        tokenized = [' '.join(word_tokenize(sent, keep_whitespace=False)) for sent in sentences]
-    
+        from pythainlp import word_tokenize
+        def tokenize(sentences):
+            return [' '.join(word_tokenize(sent, keep_whitespace=False)) for sent in sentences]
+
     elif lang_code == 'ko':
+        from g2pk2 import G2p
         ko_g2p = G2p()
-        tokenized = [ko_g2p(text) for text in df['sentence'].astype('str').tolist()]
+        def tokenize(sentences):
+            return [ko_g2p(text) for text in sentences]
+
+    else:
+        raise ValueError(f'No tokenizer for {lang_code}')
+
+    return tokenize
+
+# Tokenizer of a worker process (created once per worker by tok_init)
+worker_tokenizer = None
+
+def tok_init(lang_code):
+    global worker_tokenizer
+    worker_tokenizer = make_tokenizer(lang_code)
+
+def tok_chunk(sentences):
+    return worker_tokenizer(sentences)
+
+# Tokenize the sentences of a dataframe (sentence_id, sentence) into a sentence_tok column.
+# With n_jobs > 1 the sentences are split into chunks and tokenized on n_jobs worker processes,
+# each loading the tokenizer once; the rows keep their order, so the sentence_id join is unaffected.
+def tok_cjk(df, lang_code, n_jobs=1, chunksize=2000):
+    sentences = df['sentence'].astype('str').tolist()
+
+    start = time.time()
+    if n_jobs <= 1:
+        tokenized = make_tokenizer(lang_code)(sentences)
+    else:
+        chunks = [sentences[i:i+chunksize] for i in range(0, len(sentences), chunksize)]
+        with ProcessPoolExecutor(n_jobs, initializer=tok_init, initargs=(lang_code,)) as executor:
+            tokenized = [sentence for sentences_tok in executor.map(tok_chunk, chunks) for sentence in sentences_tok]
+    duration = time.time() - start
+    print(f'Tokenized {len(sentences)} sentences in {duration:.1f} seconds ({len(sentences) / max(duration, 1e-9):.0f} sentences/s, {max(n_jobs, 1)} processes).')
 
     # append to the dataframe
     df['sentence_tok'] = tokenized
-    df.drop(columns = 'sentence', axis = 1, inplace = True)
+    df.drop(columns = 'sentence', inplace = True)
 
     return df
 
+# Tokenizer of each language (for the sentence cache)
+tokenizer_names = {'ja': 'fugashi', 'yue': 'pycantonese', 'zh-HK': 'pycantonese', 'zh-CN': 'pkuseg', 'zh-TW': 'ckiptagger',
+                   'nan-tw': 'taibun', 'th': 'pythainlp', 'ko': 'g2pk2'}
+
+# Everything that can change the tokenized sentences of a language (for the sentence cache)
+def tok_version(lang_code):
+    packages = [tokenizer_names[lang_code], 'chinese-converter'] + (['unidic-lite', 'unidic'] if lang_code == 'ja' else [])
+    return g2p_version(lang_code, [package_version(package) for package in packages],
+                       convert_chn, make_tokenizer, jpn_postproc, jpn_part.pattern)
+
+# convert_chn and tok_cjk, with the cross-release sentence cache if given: only the sentences never seen before are tokenized
+def tok_cjk_cached(df, lang_code, n_jobs=1, cache=None):
+    if cache is None:
+        return tok_cjk(convert_chn(df, lang_code), lang_code, n_jobs)
+
+    def tokenize(sentences):
+        new_sentences = convert_chn(pd.DataFrame({'sentence': sentences}), lang_code)
+        return tok_cjk(new_sentences, lang_code, n_jobs)['sentence_tok'].tolist()
+
+    df = df.copy()
+    df['sentence_tok'] = cached_tokenize(df['sentence'].astype('str').tolist(), tokenize, lang_code,
+                                         tokenizer_names[lang_code], tok_version(lang_code), cache)
+    df.drop(columns = 'sentence', inplace = True)
+    return df
 
 def read_in_log(path):
     df = pd.read_csv(path, sep = '\t', quoting=csv.QUOTE_NONE, low_memory = False,
@@ -116,9 +187,8 @@ def read_in_log(path):
                           })
     return df
 
-# Remap speakers and generate a speaker file
-def remap_cjk_spkr(lang_dir, spkr_file_path, lang_code, output=True):
-    clip_dir = os.path.join(lang_dir, 'clips') # Where all the clips are
+# Build the table of validated clips with remapped speakers and tokenized sentences (the content of the speaker file)
+def build_cjk_validated(lang_dir, lang_code, n_jobs=1, tok_cache=None):
     valid_log = os.path.join(lang_dir, 'validated.tsv') # where the validated utterance log of common voice is
     clip_dur_file = os.path.join(lang_dir, 'clip_durations.tsv') # where the clip duration file is
 
@@ -166,8 +236,7 @@ def remap_cjk_spkr(lang_dir, spkr_file_path, lang_code, output=True):
     # Word tokenization for CJKs
     sentences = validated[['sentence_id', 'sentence']]
     unique_sentences = sentences.drop_duplicates()
-    converted_sentence = convert_chn(unique_sentences, lang_code)
-    tokenized_sentences = tok_cjk(converted_sentence, lang_code)
+    tokenized_sentences = tok_cjk_cached(unique_sentences, lang_code, n_jobs, tok_cache)
     validated = pd.merge(validated, tokenized_sentences, on= 'sentence_id', how = 'left')
 
     # Rarrange the columns so that the tokenized sentence is next to the original ones.
@@ -176,26 +245,27 @@ def remap_cjk_spkr(lang_dir, spkr_file_path, lang_code, output=True):
     target_index = cols.index('sentence_domain')
     cols.insert(target_index, 'sentence_tok')
     validated = validated[cols]
-        
+
+    return validated
+
+# Remap speakers and generate a speaker file
+# The table is loaded from the clip manifest of the language folder if its inputs (and the tokenizer) did not change since it was built
+# With the folder of a previous processed release as previous_dir, the speakers keep their speaker ids of that release (see vxc_delta.py).
+def remap_cjk_spkr(lang_dir, spkr_file_path, lang_code, output=True, n_jobs=1, tok_cache=None, release=None, previous_dir=None):
+    build = lambda: build_cjk_validated(lang_dir, lang_code, n_jobs, tok_cache)
+    version = g2p_version(read_in_log, build_cjk_validated, tok_version(lang_code))
+    inputs = validated_inputs(lang_dir)
+    if previous_dir is not None:
+        build = carry_build(build, previous_dir)
+        version = g2p_version(version, carry_build, carry_speaker_ids)
+        inputs.append(os.path.join(previous_dir, manifest_name))
+    validated = cached_manifest(lang_dir, lang_code, build, inputs, version, release)
+
     # save the speaker file
     if output:
-        if os.path.exists(spkr_file_path):
-            os.remove(spkr_file_path)
-        validated.to_csv(spkr_file_path, sep='\t', index=False)
-
-    # The file paths
-    paths = validated['path'].tolist()
-    validated['src_path'] = [os.path.join(clip_dir, path) for path in paths]
-    validated['new_path'] = [os.path.join(lang_dir, 'validated', path) for path in paths]
-    
-    # If there are more than 32000 files, split them into groups and create paths in the subfolders
-    if len(validated) > 32000:
-        root = os.path.join(lang_dir, 'validated')
-        num_groups = (len(validated) + 32000 - 1) // 32000
-        validated['subfolder'] = ["subfolder_" + str(i+1).zfill(3) for i in range(num_groups) for _ in range(min(32000, len(validated) - i*32000))]
-        validated['sub_path'] = [os.path.join(root, i, j) for i, j in zip(validated.subfolder, validated.path)]
+        export_speaker_file(validated, spkr_file_path, lang_dir)
 
-    return validated
+    return compact_clips(validated, lang_dir)
 
 ##################################################################################################
 ##################################################################################################
@@ -216,7 +286,7 @@ def create_textgrid(snd_file, dur, speaker_id, transcript):
     tg.save(tg_filename, format='short_textgrid', includeBlankSpaces=True)
 
 def move_and_create_cjk_tg(df):
-    for src_mp3_path, new_path, speaker, dur, transcript in zip(df.src_path, df.new_path, df.speaker_id, df.dur, df.sentence_tok):
+    for src_mp3_path, new_path, speaker, dur, transcript in zip(iter_clip_paths(df, 'src'), iter_clip_paths(df, 'new'), df.speaker_id, df.dur, df.sentence_tok):
         src_mp3_path = Path(src_mp3_path)
         new_path = Path(new_path)
         # Copy sound file and crate the textgrid file  
@@ -228,7 +298,7 @@ def move_and_create_cjk_tg(df):
             # Get the textgrid file name
             tg_filename = new_path.with_suffix('.TextGrid')
             if not os.path.exists(tg_filename):
-                create_textgrid(new_path, dur, speaker, transcript)
+                create_textgrid(new_path, dur, str(speaker), transcript)
 
 
 ##################################################################################################
@@ -238,98 +308,197 @@ def move_and_create_cjk_tg(df):
 # G2P
 
 # Epitran
-ipa_symbols = re.compile(r'[\u0020-\u007E\u00A0-\u00FF\u0100-\u017F\u0180-\u024F\u0250-\u02AF\u02B0-\u02FF\u0300-\u036F\u0370-\u03FF\u1AB0-\u1AFF\u1DC0-\u1DFF\u2000-\u206F\u2070-\u209F\u2190-\u21FF\u2C60-\u2C7F\uA700-\uA71F]+|\s')
-
-def filter_ipa_symbols(input_string):
-    filtered_string = ''.join(char for char in input_string if ipa_symbols.match(char))
-
-    return filtered_string if len(filtered_string) == len(input_string) else ''
+# The IPA sanitizer (clean_ipa, filter_ipa_symbols) is in vxc_ipa.py
+
+# Syllable tables
+# Mandarin, Cantonese and Taiwanese Min Nan only have a couple of thousand distinct tonal syllables, so the IPA of each
+# syllable is computed once and words are put together by lookup. The tables are saved next to the G2P cache
+# (one file per language and version of the syllable conversion), so later runs start with every syllable seen before.
+syllable_dir = os.path.join(os.path.expanduser('~'), '.cache', 'voxcommunis', 'syllables')
+
+class SyllableTable:
+    def __init__(self, name, convert, version, directory=syllable_dir):
+        self.convert = convert
+        self.path = os.path.join(directory, f'{name}_{version}.tsv') if directory is not None else None
+        self.table = {}
+        self.n_new = 0
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf8') as f:
+                for line in f:
+                    syllable, ipa = line.rstrip('\n').split('\t')
+                    self.table[syllable] = ipa
+
+    def __getitem__(self, syllable):
+        ipa = self.table.get(syllable)
+        if ipa is None:
+            ipa = self.convert(syllable)
+            self.table[syllable] = ipa
+            self.n_new += 1
+        return ipa
+
+    # Convert a list of syllables ahead of time (e.g. the whole syllable inventory of a language)
+    def precompute(self, syllables):
+        for syllable in syllables:
+            self[syllable]
+
+    # Write the table if new syllables were added (to a temporary file first, so an interrupted run leaves no partial table)
+    def save(self):
+        if self.path is None or self.n_new == 0:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            for syllable, ipa in self.table.items():
+                if '\t' not in syllable + ipa and '\n' not in syllable + ipa:
+                    f.write(syllable + '\t' + ipa + '\n')
+        os.replace(tmp_path, self.path)
+        self.n_new = 0
+
+# Syllable tables of this process, by language
+syllable_tables = {}
+
+def syllable_table(name, epi=None):
+    if name not in syllable_tables:
+        if name == 'cmn':
+            table = SyllableTable('cmn', cmn_syllable, g2p_version(package_version('pinyin_to_ipa'), cmn_syllable))
+        elif name == 'nan':
+            table = SyllableTable('nan', nan_syllable, g2p_version(ipa_version(), nan_syllable))
+        elif name == 'yue':
+            table = SyllableTable('yue', lambda syllable: yue_syllable(epi, syllable), g2p_version(package_version('epitran'), ipa_version(), yue_syllable))
+        syllable_tables[name] = table
+    return syllable_tables[name]
+
+# Cantonese: IPA of a jyutping syllable
+jyutping_syllable = re.compile(r'[a-z]+[1-6]?')
+
+def yue_syllable(epi, syllable):
+    phone = epi.transliterate(syllable)
+    phone = re.sub(":", "ː", phone)
+    # Attach the unreleased symbol to the coda stops
+    phone = re.sub(r'(p|pʰ|t|tʰ|k|kʰ)($|p|t|t͡s|s|f|k|m|n|ŋ|l|j|w|h|ʔ)', lambda m: f"{m.group(1).replace('ʰ', '')}̚{m.group(2)}", phone) 
+    phone = segment_ipa(phone)
+    phone = re.sub(r'j (i|y)', r'\1', phone) # get rid of j before i or y 
+    phone = re.sub('w u', 'u', phone)  # get rid of w before u
+    phone = re.sub(r'(k|kʰ)ʷ ', r'\1 ʷ', phone) # move the w onglide to group it with the rime instead of the consonant
+    return phone
+
+# Epitran conversion of CJK and Thai words other than Japanese: returns (word, phone, clean_phone) for each word
+def epi_cjk_convert(epi, words, epi_code):
+    if epi_code == 'yue-Latn':
+        import pycantonese
+        yue_table = syllable_table('yue', epi)
+    triples = []
+    for word in words:
+        if epi_code == 'yue-Latn': # G2P Cantonese
+            # The word is put together from the IPA of its jyutping syllables
+            jyutping = [syllables for segment, syllables in pycantonese.characters_to_jyutping(word)]
+            if len(jyutping) == 0 or None in jyutping:
+                phone = ''
+            else:
+                phone = ' '.join(yue_table[syllable] for syllable in jyutping_syllable.findall(' '.join(jyutping)))
+        elif epi_code == 'kor-Hang':
+            phone = epi.transliterate(word)
+            phone = segment_ipa(phone, merge_vowels=False)
+            phone = re.sub('d ʑ', 'd͡ʑ', phone)
+        else: # Any other langauges
+            phone = epi.transliterate(word)  
+            phone = segment_ipa(phone)
+
+        phone = re.sub(":", "ː", phone)
+        # Separate any identical ipa symbols repeated twice with a white space
+        phone = re.sub(r'([\u0020-\u007E\u00A0-\u00FF\u0100-\u017F\u0180-\u024F\u0250-\u02AF\u02B0-\u02FF\u0300-\u036F\u0370-\u03FF])\1', r'\1 \1', phone)
+        
+        # Estonian super long vowels
+        if epi_code == 'est-Latn':
+            phone = re.sub('ː ː', 'ːː', phone) # String the super long symbol back
+        phone = re.sub(r'ˈ|ˌ', '', phone) # strip the stress markers
+
+        # Get rid of the non-IPAs from the output
+        clean_phone = clean_ipa(phone)
+
+        triples.append((word, phone, clean_phone))
+
+    if epi_code == 'yue-Latn':
+        yue_table.save()
+    return triples
+
+# Japanese
+# The words are converted to kana by pykakasi (each distinct word once), and the kana readings to IPA by Epitran.
+# The IPA of each distinct reading is memoized, since many words share a reading (kanji and kana spellings,
+# inflected forms). The rewrites after Epitran are compiled once and applied in a single pass each.
+
+# Merge repeated segments into long ones
+jpn_long = re.compile(r'(\S+) \1')
+# Devoice the high vowels between voiceless consonants. The following consonant is matched by a lookahead,
+# so a chain of devoiceable vowels is handled in one pass (same result as substituting until nothing changes).
+jpn_devoice = re.compile(r'(p|t|k|kʲ|s|ç|ɕ)(ː?) (i|ɯ)(?= (?:p|t|k|kʲ|s|ç|ɕ))')
+jpn_rewrites = [(re.compile('o ɯ'), 'oː'), (re.compile(r'(ː̃ )'), r'\1 '), (re.compile('ɰ'), 'w'), (re.compile('ɖ'), 'ɾ')]
+
+jpn_kakasi = None
+jpn_ipa_memo = {}
+
+# Kana reading of a word from the pykakasi items
+def jpn_reading(items):
+    reading = []
+    for ind, i in enumerate(items):
+        kana = i['kana']
+        if i['orig'] in ['いう', '言う']:
+            kana = 'ユウ'
+        if ind == len(items) - 1:
+            if i['orig'] == 'は':
+                kana = 'ワ'
+            elif i['orig'] == 'へ':
+                kana = 'エ'
+        reading.append(kana)
+    return ''.join(reading)
+
+# IPA of a kana reading
+def jpn_kana_ipa(epi, reading):
+    if reading not in jpn_ipa_memo:
+        pron = ' '.join(epi.trans_list(reading))
+        pron = jpn_long.sub(r'\1ː', pron)
+        pron = jpn_devoice.sub(r'\1\2 \3̥', pron)
+        for pattern, repl in jpn_rewrites:
+            pron = pattern.sub(repl, pron)
+        jpn_ipa_memo[reading] = pron
+    return jpn_ipa_memo[reading]
+
+# Same interface as epi_cjk_convert: (word, phone, clean_phone) triples, with clean_phone '' if the pronunciation has non-IPA symbols
+def jpn_convert(epi, words, epi_code='jpn-Ktkn'):
+    global jpn_kakasi
+    if jpn_kakasi is None:
+        import pykakasi
+        jpn_kakasi = pykakasi.kakasi()
+    readings = {word: jpn_reading(jpn_kakasi.convert(word)) for word in dict.fromkeys(words)}
+    triples = []
+    for word in words:
+        pron = jpn_kana_ipa(epi, readings[word])
+        triples.append((word, pron, filter_ipa_symbols(pron)))
+    return triples
 
-def epi_cjk_g2p(words, epi_code, dict_file_path):
-    epi = epitran.Epitran(epi_code)
+def jpn_version():
+    return g2p_version(package_version('epitran'), package_version('pykakasi'), ipa_version(), jpn_reading, jpn_kana_ipa, jpn_convert,
+                       jpn_long.pattern, jpn_devoice.pattern, [(pattern.pattern, repl) for pattern, repl in jpn_rewrites])
 
+def epi_cjk_g2p(words, epi_code, dict_file_path, n_jobs=1):
     if epi_code == 'jpn-Ktkn': # G2P Japanese
-        kks = pykakasi.kakasi()
-        katn = [kks.convert(word) for word in words]
-        trans = []
-        for item, word in zip(katn, words):
-            #print(item)
-            reading = []
-            for ind, i in enumerate(item):
-                if i['orig'] in ['いう', '言う']:
-                    i['kana'] = 'ユウ'
-                if ind == len(item) - 1:
-                    if i['orig'] == 'は':
-                        i['kana'] = 'ワ'
-                    elif i['orig'] == 'へ':
-                        i['kana'] = 'エ'
-                #reading = ''.join(reading)
-            reading = ''.join(reading)
-            #print(''.join(reading))
-            pron = epi.trans_list(reading)
-            pron = ' '.join(pron)
-            pron = re.sub(r'(\S+) \1', r'\1ː', pron)
-            hv_devoice_pattern = re.compile(r"(p|t|k|kʲ|s|ç|ɕ)([ː]?) (i|ɯ) (p|t|k|kʲ|s|ç|ɕ)([ː]?)")
-            while True:
-                pron, count = re.subn(hv_devoice_pattern, r"\1\2 \3̥ \4\5", pron)
-                if count == 0:  # No more replacements possible
-                    break
-
-            pron = re.sub('o ɯ', 'oː', pron)
-            pron = re.sub(r'(ː̃ )', r'\1 ', pron)
-            pron = re.sub('ɰ', 'w', pron)
-            pron = re.sub('ɖ', 'ɾ', pron)
-            clean_pron = filter_ipa_symbols(pron)
+        import epitran
+        epi = epitran.Epitran(epi_code)
+        triples = jpn_convert(epi, words)
+        for word, pron, clean_pron in triples:
             if pron != clean_pron:
                 print(word + '\t"' + pron + '"\t"' + clean_pron + '"')
-            if clean_pron != '':
-                entry = word + '\t' + clean_pron
-                trans.append(entry)
 
         with open(dict_file_path, 'w') as f:
-            for i in trans:
-                f.write(i + '\n')
+            for word, pron, clean_pron in triples:
+                if clean_pron != '':
+                    f.write(word + '\t' + clean_pron + '\n')
 
     else:
-        lex_dict = {}
-        for word in words:
-            if epi_code == 'yue-Latn': # G2P Cantonese
-                jyutping = pycantonese.characters_to_jyutping(word)[0][1]
-                if jyutping is None:
-                    phone = ''
-                else:
-                    phone = epi.transliterate(jyutping)
-                    phone = re.sub(":", "ː", phone)
-                    # Attach the unreleased symbol to the coda stops
-                    phone = re.sub(r'(p|pʰ|t|tʰ|k|kʰ)($|p|t|t͡s|s|f|k|m|n|ŋ|l|j|w|h|ʔ)', lambda m: f"{m.group(1).replace('ʰ', '')}̚{m.group(2)}", phone) 
-                    phone = ' '.join(ipa2tokens(phone))
-                    phone = re.sub(r'j (i|y)', r'\1', phone) # get rid of j before i or y 
-                    phone = re.sub('w u', 'u', phone)  # get rid of w before u
-                    phone = re.sub(r'(k|kʰ)ʷ ', r'\1 ʷ', phone) # move the w onglide to group it with the rime instead of the consonant
-            elif epi_code == 'kor-Hang':
-                phone = epi.transliterate(word)
-                phone = ' '.join(ipa2tokens(phone, merge_vowels = False))
-                phone = re.sub('d ʑ', 'd͡ʑ', phone)
-            else: # Any other langauges
-                phone = epi.transliterate(word)  
-                phone = ' '.join(ipa2tokens(phone))
-
-            phone = re.sub(":", "ː", phone)
-            # Separate any identical ipa symbols repeated twice with a white space
-            phone = re.sub(r'([\u0020-\u007E\u00A0-\u00FF\u0100-\u017F\u0180-\u024F\u0250-\u02AF\u02B0-\u02FF\u0300-\u036F\u0370-\u03FF])\1', r'\1 \1', phone)
-            
-            # Estonian super long vowels
-            if epi_code == 'est-Latn':
-                phone = re.sub('ː ː', 'ːː', phone) # String the super long symbol back
-            phone = re.sub(r'ˈ|ˌ', '', phone) # strip the stress markers
-
-            # Get rid of the non-IPAs from the output
-            only_ipa = re.findall(ipa_symbols, phone)
-            clean_phone = ' '.join(only_ipa)
-
-            lex_dict[word] = clean_phone
-            if phone != clean_phone:
-                print(word + ': ' + phone + '\t' + clean_phone)
+        # Convert the words on n_jobs worker processes, each with its own Epitran instance
+        triples = epi_transliterate(words, epi_code, epi_cjk_convert, n_jobs)
+        report_g2p_diffs(triples)
+        lex_dict = {word: clean_phone for word, phone, clean_phone in triples}
 
         # write to outfile
         with open(dict_file_path, 'w') as dict_file:
@@ -337,99 +506,152 @@ def epi_cjk_g2p(words, epi_code, dict_file_path):
                 if phone.strip() != '': 
                     dict_file.write(word + '\t' + phone + "\n")
 
+# Epitran for CJK and Thai other than Japanese, with its own engine name in the G2P cache since the output differs from epi
+class EpiCJKBackend(EpiBackend):
+    engine = 'epi-cjk'
+
+    def version(self):
+        if self.lang == 'jpn-Ktkn':
+            return jpn_version()
+        return g2p_version(epi_version(self.lang), epi_cjk_convert, yue_syllable)
+
+    def convert(self, words):
+        convert = jpn_convert if self.lang == 'jpn-Ktkn' else epi_cjk_convert
+        triples = convert(self.loaded, words, self.lang)
+        report_g2p_diffs(triples)
+        return [(word, clean_phone) for word, phone, clean_phone in triples]
 
 # Chinese g2p
+# Mandarin: IPA of a pinyin syllable (with its tone number)
+def cmn_syllable(py):
+    from pinyin_to_ipa import pinyin_to_ipa
+    ipa = ' '.join(pinyin_to_ipa(py)[0])
+    ipa = re.sub('[˥˦˧˨˩]', '', ipa)
+    # Make onglides superscript and attach them to the following vowel
+    ipa = re.sub(r'(p|m|f|t|n|l|k|x|s|ʂ|ɻ|ʰ) w ', r'\1 ʷ', ipa)
+    ipa = re.sub(r'(p|t|m|n|l|ɕ|ʰ) j ', r'\1 ʲ', ipa)
+    ipa = re.sub(r'(n|l|ɕ|ʰ) ɥ ', r'\1 ᶣ', ipa)
+    ipa = re.sub('a ŋ', 'ɑ ŋ', ipa)
+    return ipa
+
+# All the pinyin syllables (with tone numbers) of the characters pypinyin knows
+def cmn_syllable_inventory():
+    from pypinyin.pinyin_dict import pinyin_dict
+    from pypinyin.contrib.tone_convert import to_tone3
+    return sorted(set(to_tone3(reading) for readings in pinyin_dict.values() for reading in readings.split(',')))
+
 def convert_cmn(chinese_text):
+    from pypinyin import pinyin, Style
+    # The pinyin of the word (the reading of a character can depend on the word), then the IPA of each syllable
     py = pinyin(chinese_text, style=Style.TONE3)
-    # Flatten the list and join words with spaces
-    py = [item[0] for item in py]
-    # Get each syllable
-    ipa = [pinyin_to_ipa(item)[0] for item in py]
-    ipa = [' '.join(sound) for sound in ipa]
-    ipa = [re.sub('[˥˦˧˨˩]', '', sound) for sound in ipa]
-    # Make onglides superscript and attach them to the following vowel
-    ipa = [re.sub(r'(p|m|f|t|n|l|k|x|s|ʂ|ɻ|ʰ) w ', r'\1 ʷ', syll) for syll in ipa]
-    ipa = [re.sub(r'(p|t|m|n|l|ɕ|ʰ) j ', r'\1 ʲ', syll) for syll in ipa]
-    ipa = [re.sub(r'(n|l|ɕ|ʰ) ɥ ', r'\1 ᶣ', syll) for syll in ipa]
-    ipa = [re.sub('a ŋ', 'ɑ ŋ', syll) for syll in ipa]
-    ipa = ' '.join(ipa)
+    cmn_table = syllable_table('cmn')
+    ipa = ' '.join(cmn_table[item[0]] for item in py)
     
     transcript = chinese_text + '\t' + ipa
     
     return transcript
 
-def cmn_g2p(words, dict_file_path):
-    g2p_res = []    
-    for word in words:
-        transcript = convert_cmn(word)
-        g2p_res.append(transcript)
+def cmn_version():
+    return g2p_version(package_version('pypinyin'), package_version('pinyin_to_ipa'), convert_cmn, cmn_syllable)
+
+# (word, IPA) pairs of a list of words; the syllable table is filled with the whole pinyin inventory the first time
+# and saved after the words are converted
+def cmn_convert(words):
+    cmn_table = syllable_table('cmn')
+    if len(cmn_table.table) == 0:
+        cmn_table.precompute(cmn_syllable_inventory())
+    pairs = [convert_cmn(word).split('\t') for word in words]
+    cmn_table.save()
+    return pairs
+
+def cmn_g2p(words, dict_file_path, cache=None):
+    # Only the words that are not in the G2P cache (if any) are converted
+    lex_dict = cached_g2p(words, cmn_convert, 'cmn', cmn_version(), 'zh-CN', cache)
     
     with open(dict_file_path, 'w') as dict:
-        for line in g2p_res:
-            dict.write(line + '\n')
+        for word in words:
+            dict.write(word + '\t' + lex_dict[word] + '\n')
 
 # Taiwanese Minnan G2P
 
-def nan_g2p(words, dict_file_path):
+# Taiwanese Min Nan: segmentation of the IPA of a syllable from taibun
+def nan_syllable(syllable):
+    trans = re.sub(r'(t|d)(z|ʑ|s|ɕ)', r'\1͡\2', syllable)
+    trans = re.sub('chı', 't͡ɕi', trans)
+    return segment_ipa(trans)
+
+def nan_convert(words):
+    import taibun
     c = taibun.Converter(system='IPA', format='strip')
+    nan_table = syllable_table('nan')
     g2p_res = []
     ipa = [c.get(word).lower() for word in words]
     ipa = [i.split(' ') for i in ipa]
     for word in ipa:
-        trans = [re.sub(r'(t|d)(z|ʑ|s|ɕ)', r'\1͡\2', i) for i in word]
-        trans = [re.sub('chı', 't͡ɕi', i) for i in trans]
-        trans = [' '.join(ipa2tokens(i)) for i in trans]
-        trans = ' '.join(trans)
+        trans = ' '.join(nan_table[i] for i in word)
         g2p_res.append(trans)
         #print(trans)
+    nan_table.save()
+
+    g2p_res = [re.sub(r'[\u4e00-\u9fff\u3400-\u4dbf\uf900-\ufaff]', '', phone) for phone in g2p_res]
+    return list(zip(words, g2p_res))
+
+def nan_version():
+    return g2p_version(package_version('taibun'), ipa_version(), nan_convert, nan_syllable)
+
+def nan_g2p(words, dict_file_path, cache=None):
+    # Only the words that are not in the G2P cache (if any) are converted
+    lex_dict = cached_g2p(words, nan_convert, 'nan', nan_version(), 'nan-tw', cache)
 
     with open(dict_file_path, 'w') as f:
-        for word, phone in zip(words, g2p_res):
-            phone = re.sub(r'[\u4e00-\u9fff\u3400-\u4dbf\uf900-\ufaff]', '', phone)
+        for word in words:
+            phone = lex_dict[word]
             if phone != '':
                 f.write(word+'\t'+phone+'\n')
 
+class CmnBackend(G2PBackend):
+    engine = 'cmn'
+    word_cost = 1e-3
+
+    def __init__(self):
+        super().__init__('zh-CN')
+
+    def version(self):
+        return cmn_version()
+
+    def convert(self, words):
+        return cmn_convert(words)
+
+class NanBackend(G2PBackend):
+    engine = 'nan'
+    word_cost = 1e-3
+
+    def __init__(self):
+        super().__init__('nan-tw')
+
+    def version(self):
+        return nan_version()
+
+    def convert(self, words):
+        return nan_convert(words)
+
 # Korean G2P
-def kor_xpf(words, xpf_translater_path, rule_file_path, verify_file_path, word_file_path, inter_file_path, dict_file_path):
+def kor_xpf(words, rule_file_path, verify_file_path, dict_file_path):
     from g2pk import G2p # type: ignore
+    from xpf_translate04 import load, CACHE_DIR
     kor_g2p = G2p()
-    # Figure out Korean phonology hidden in their orthography
-    kor_conv = [kor_g2p(word) for word in words]
-    kor_conv_words = inter_file_path
-    # Save the interim conversion to a file
-    with open(kor_conv_words, 'w') as word_file:
-        for word in kor_conv:
-            word_file.write(word + "\n")
-            
-    # XPF convert Korean to IPA using the interim file
-    g2p_cmd = ["python", xpf_translater_path, "-l", rule_file_path, "-c", verify_file_path, "-r", kor_conv_words] # XPF translating command that will be sent to subprocess.run() to execute.
-
-    with open(dict_file_path,'w') as dict_file:
-        subprocess.run(g2p_cmd, stdout = dict_file) # stdout = ... means to send the output to the file (so you have to open this file first as above)
-
-    # This is to get rid of all the '@' in the lexicon (if there is any). @ means that XPF G2P failure
-    with open(dict_file_path, "r") as dict_file:
-        dict = dict_file.read().split("\n")
 
+    # Load the XPF rules and check them against the verification file (both reused from the cache if the files are unchanged)
+    with open(rule_file_path, 'r', encoding='utf8') as rule_file, open(verify_file_path, 'r', encoding='utf8') as verify_file:
+        a2ipa, verified = load(rule_file, verify_file, cachedir=CACHE_DIR)
+    if not verified:
+        xpf_failed('Verification failed, not processing additional data', dict_file_path)
+        return
+
+    # Figure out Korean phonology hidden in their orthography, then XPF convert the result to IPA.
+    # The IPA is paired with the original word; words XPF can't figure out are left out.
     with open(dict_file_path, 'w') as dict_file:
-        for i in dict:
-            i = re.sub(" ː", "ː", i)
-            # Get rid of words that contain sounds XPF can't figure out
-            if '@' not in i:
-                dict_file.write(i + "\n")
-    
-    # Append the converted IPA transcription to the original word list file.
-    kor_ipa = []
-    with open(dict_file_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            parts = line.split('\t')
-            if len(parts) == 2:
-                _, string2 = parts
-                kor_ipa.append(string2)
-    with open(word_file_path, 'r') as f:
-        kor_words = f.readlines()
-        kor_words = [word.strip() for word in kor_words]
-    with open(dict_file_path, 'w') as f:
-        for word, ipa in zip(kor_words, kor_ipa):
-            f.write(word+'\t'+ipa+'\n')
\ No newline at end of file
+        for word in words:
+            phone = a2ipa.entry(kor_g2p(word))
+            if phone is not None:
+                dict_file.write(word + '\t' + phone + '\n')
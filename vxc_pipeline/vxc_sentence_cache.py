@@ -0,0 +1,91 @@
+import os, hashlib
+from vxc_lexicon_cache import KeyValueCache, cache_cli
+
+# Cross-release sentence tokenization cache
+# The sentences of a Common Voice release for ja, zh-CN, zh-HK, yue, nan-tw, ko and th are almost all in the next release too,
+# so their tokenized form (sentence_tok, after the Chinese script conversion and the word tokenizer) is kept in a local
+# SQLite database keyed by (language, tokenizer, version, hash of the sentence) and only new sentences are tokenized.
+# The version is a hash of the tokenizer package version and the tokenization code (see vxc_processing_cjk.tok_version).
+# Hits and misses are counted per language, tokenizer and version, and shown by `python vxc_sentence_cache.py stats`.
+# Lookups never delete entries: the entries of older versions are dropped with `python vxc_sentence_cache.py prune --version ...`.
+
+cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'voxcommunis', 'sentence_tok.sqlite')
+
+##########################################################################################################
+##########################################################################################################
+
+def sentence_hash(sentence):
+    return hashlib.sha1(sentence.encode('utf8')).hexdigest()
+
+class SentenceCache(KeyValueCache):
+    table = 'sentences'
+    scope = ('lang', 'tokenizer', 'version')
+    stats_columns = scope
+    stats_extra = ('hits', 'misses')
+    item = 'hash'
+    value = 'sentence_tok'
+    extra_tables = ('usage',)
+
+    def __init__(self, path=cache_path):
+        super().__init__(path)
+        self.con.execute('''CREATE TABLE IF NOT EXISTS usage (
+                                lang TEXT, tokenizer TEXT, version TEXT, hits INTEGER, misses INTEGER,
+                                PRIMARY KEY (lang, tokenizer, version))''')
+        self.con.commit()
+
+    # Cached tokenized sentences, as a dict of sentence hash: sentence_tok
+    def lookup(self, lang, tokenizer, version, hashes):
+        return self.lookup_items((lang, tokenizer, version), hashes)
+
+    # Store (sentence hash, sentence_tok) pairs
+    def store(self, lang, tokenizer, version, pairs):
+        self.store_items((lang, tokenizer, version), pairs)
+
+    # Add the hits and misses of a run to the counts
+    def count(self, lang, tokenizer, version, hits, misses):
+        self.con.execute('INSERT OR IGNORE INTO usage VALUES (?, ?, ?, 0, 0)', (lang, tokenizer, version))
+        self.con.execute('UPDATE usage SET hits = hits + ?, misses = misses + ? WHERE lang = ? AND tokenizer = ? AND version = ?',
+                         (hits, misses, lang, tokenizer, version))
+        self.con.commit()
+
+    # Number of entries, hits and misses per language, tokenizer and version
+    def stats(self, **conditions):
+        query, args = self._where(conditions, prefix='s.')
+        return self.con.execute('SELECT s.lang, s.tokenizer, s.version, COUNT(*), COALESCE(u.hits, 0), COALESCE(u.misses, 0) '
+                                'FROM sentences s LEFT JOIN usage u ON s.lang = u.lang AND s.tokenizer = u.tokenizer AND s.version = u.version' +
+                                query + ' GROUP BY s.lang, s.tokenizer, s.version ORDER BY s.lang, s.tokenizer, s.version', args).fetchall()
+
+# Tokenize only the sentences that are not in the cache.
+# tokenize takes a list of sentences and returns the list of tokenized sentences.
+# Returns the tokenized sentences in the order of the input.
+def cached_tokenize(sentences, tokenize, lang, tokenizer, version, cache=None):
+    if cache is None:
+        return tokenize(list(sentences))
+
+    hashes = [sentence_hash(sentence) for sentence in sentences]
+    tok_dict = cache.lookup(lang, tokenizer, version, hashes)
+    new_sentences = {sha: sentence for sha, sentence in zip(hashes, sentences) if sha not in tok_dict}
+    n_hits = len(set(hashes)) - len(new_sentences)
+
+    if len(new_sentences) > 0:
+        new_pairs = list(zip(new_sentences, tokenize(list(new_sentences.values()))))
+        cache.store(lang, tokenizer, version, new_pairs)
+        tok_dict.update(new_pairs)
+    cache.count(lang, tokenizer, version, n_hits, len(new_sentences))
+
+    n_sentences = n_hits + len(new_sentences)
+    hit_rate = n_hits / n_sentences if n_sentences > 0 else 0
+    print(f'Sentence cache ({tokenizer}, {lang}): {n_hits} of {n_sentences} sentences cached ({hit_rate:.1%}), {len(new_sentences)} tokenized.')
+    return [tok_dict[sha] for sha in hashes]
+
+##########################################################################################################
+##########################################################################################################
+
+def main():
+    cache_cli(SentenceCache, 'Inspect, invalidate or prune the cross-release sentence tokenization cache', cache_path,
+              {'lang': 'Common Voice language code (ja, zh-CN, zh-HK, yue, nan-tw, ko, th)',
+               'tokenizer': 'tokenizer (fugashi, pkuseg, ckiptagger, pycantonese, taibun, pythainlp, g2pk2)',
+               'version': 'tokenizer version hash'})
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,26 @@
 import re
 import argparse
 import sys
+import os
+import io
 import csv
+import hashlib
+import pickle
+import time
 import traceback
+from multiprocessing import Pool
 from collections import deque, defaultdict
 from math import inf
 
 
+##
+## Compiled rules are cached here by default. CACHE_VERSION is part of
+## the cache key: bump it whenever alphabet2ipa changes what it keeps.
+##
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "voxcommunis", "xpf")
+CACHE_VERSION = 1
+
+
 def sniff(filestream):
     ##sample = csv.Sniffer().sniff(filestream.read(1024))
     lines = list(line for line in filestream if not (line.startswith("#") or len(line) == 0))
@@ -24,6 +38,40 @@ def sniff(filestream):
     return (lines, dialect)
 
 
+def positional(pattern):
+    ##
+    ## Whether a follow context can be matched in place, at a position
+    ## of the word, instead of on the rest of the word sliced out of
+    ## it. Top level alternatives, start anchors, word boundaries and
+    ## lookbehinds behave differently once the match starts inside the
+    ## string, so those contexts keep using the slice.
+    ##
+    depth = 0
+    classStart = None
+    escaped = False
+    for (px, char) in enumerate(pattern):
+        if escaped:
+            escaped = False
+            if classStart is None and char in "AbB":
+                return False
+        elif char == "\\":
+            escaped = True
+        elif not classStart is None:
+            if char == "]" and px > classStart + 1 and not (px == classStart + 2 and pattern[px-1] == "^"):
+                classStart = None
+        elif char == "[":
+            classStart = px
+        elif char == "(":
+            if pattern.startswith("(?<=", px) or pattern.startswith("(?<!", px):
+                return False
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "^" or (char == "|" and depth == 0):
+            return False
+    return True
+
+
 class subrule(object):
     ##
     ## simple wrapper for sub rules
@@ -41,15 +89,41 @@ class subrule(object):
 
         self.weight = float(self.weight)
         self.sfrom = re.compile(self.sfrom)
+
+        ##
+        ## Contexts are checked in place on the word (see contextAt),
+        ## empty ones always apply
+        ##
+        self.anyPrecede = len(self.precede) == 0
+        self.anyFollow = len(self.follow) == 0
+        self.followAt = re.compile(self.follow) if positional(self.follow) else None
         self.precede = re.compile(self.precede+"$")
         self.follow = re.compile("^"+self.follow)
 
     def subScore(self, sfrom, precede, follow):
-        if self.sfrom.match(sfrom) and self.precede.search(precede) and self.follow.search(follow):
+        if self.sfrom.match(sfrom) and self.contextMatch(precede, follow):
             return self.weight
         else:
             return None
 
+    def contextMatch(self, precede, follow):
+        return self.precede.search(precede) and self.follow.search(follow)
+
+    def contextAt(self, source, sx):
+        ##
+        ## Same as contextMatch(source[:sx], source[sx+1:]), without
+        ## building the two slices: searching up to endpos behaves as
+        ## if the string ended there, and the follow context is matched
+        ## from the next position on
+        ##
+        if not (self.anyPrecede or self.precede.search(source, 0, sx)):
+            return False
+        if self.anyFollow:
+            return True
+        if self.followAt is None:
+            return self.follow.search(source[sx+1:])
+        return self.followAt.match(source, sx+1)
+
     def sub(self, x):
         return self.sfrom.sub(self.sto, x)
 
@@ -75,6 +149,7 @@ class alphabet2ipa(object):
         self.classes = dict()
         self.subs = set()
         self.ipasubs = set()
+        self.index = dict()
         self.words = dict()
         self.matches = dict()
         self.pre = str.maketrans("", "")
@@ -151,6 +226,31 @@ class alphabet2ipa(object):
                 if self.loglevel > 1:
                     print("Rule added:", rule, file=sys.stderr)
 
+        ##
+        ## Index the sub rules by the characters they can translate, so
+        ## that translate only looks at the candidates of each
+        ## character. Characters spelled out in some sfrom are indexed
+        ## now, anything else (e.g. reached through . or \w) the first
+        ## time it is seen.
+        ##
+        for char in set("".join(rule.sfrom.pattern for rule in self.subs)):
+            self.candidates(char)
+
+        ##
+        ## IPA sub rules are applied by decreasing weight
+        ##
+        self.ipaorder = [rule for (weight, rule) in sorted((-rule.weight, rule)
+                                                            for rule in self.ipasubs)]
+
+
+    def candidates(self, sfrom):
+        ##
+        ## Sub rules whose sfrom matches the character, best weight first
+        ##
+        if sfrom not in self.index:
+            self.index[sfrom] = sorted((rule for rule in self.subs if rule.sfrom.match(sfrom)),
+                                       key=lambda rule: -rule.weight)
+        return self.index[sfrom]
 
 
 
@@ -188,25 +288,20 @@ class alphabet2ipa(object):
             ##
             else:
                 ##
-                ## prepare context
-                ##
-                precede = "".join(source[:sx])
-                follow = "".join(source[sx+1:])
-                
-                ##
-                ## perform all possible translations
-                ##
-                translations = [(rule.subScore(sfrom, precede, follow), rule.sub(sfrom)) for rule in self.subs]
-                
+                ## Choose best translation: the highest weight among the
+                ## candidates whose context applies (ties go to the
+                ## greatest translation, as when sorting all of them)
                 ##
-                ## Exclude translations that didn't apply
-                ##
-                translations = [pair for pair in translations if not pair[0] is None]
-                
-                ##
-                ## Choose best translation
-                ##
-                translation = sorted(translations)[-1][-1] if len(translations) > 0 else self.NO_TRANSLATE
+                best = None
+                for rule in self.candidates(sfrom):
+                    if not best is None and rule.weight < best[0]:
+                        break
+                    if rule.contextAt(source, sx):
+                        option = (rule.weight, rule.sub(sfrom))
+                        if best is None or option > best:
+                            best = option
+
+                translation = best[-1] if not best is None else self.NO_TRANSLATE
 
             if len(translation) == 0:
                 continue
@@ -214,8 +309,7 @@ class alphabet2ipa(object):
             targetList.append(translation)
 
         targetString = " ".join(targetList)
-        for (weight, rule) in sorted((-rule.weight, rule)
-                                     for rule in self.ipasubs):
+        for rule in self.ipaorder:
             targetString = rule.sub(targetString)
         
 
@@ -223,6 +317,39 @@ class alphabet2ipa(object):
         return list(targetString.split())
 
 
+    def entry(self, word, translation=None):
+        ##
+        ## Lexicon entry for a word: the translation with length marks
+        ## joined to the preceding sound, or None if the word (or some
+        ## of its characters) could not be translated. The space
+        ## separated translation can be given if already known.
+        ##
+        if translation is None:
+            translation = " ".join(self.translate(word))
+        translation = translation.replace(" ː", "ː")
+        if len(self.NO_TRANSLATE) > 0 and (self.NO_TRANSLATE in word or self.NO_TRANSLATE in translation):
+            return None
+        return translation
+
+
+    def translate_many(self, words, jobs=1):
+        ##
+        ## Stream (word, translation) pairs for a whole word list,
+        ## leaving out the words that could not be translated. With
+        ## more than one job, words are translated in parallel (see
+        ## translate_parallel), still in input order.
+        ##
+        if jobs > 1:
+            pairs = translate_parallel(self, words, jobs)
+        else:
+            pairs = ((word, " ".join(self.translate(word))) for word in words)
+
+        for (word, translation) in pairs:
+            translation = self.entry(word, translation)
+            if not translation is None:
+                yield (word, translation)
+
+
     def check(self, cfile):
         ##
         ## Check that words translate as they should. Returns True if
@@ -270,6 +397,109 @@ class alphabet2ipa(object):
                     
         return allGood
 
+def load(langrules, check=None, missing="@", loglevel=0, cachedir=None):
+    ##
+    ## Rules ready for translation, and whether they pass the
+    ## verification file (True if there is none).
+    ##
+    ## With a cache directory, the compiled rules (classes, sub and
+    ## ipasub rules, match and word tables) and the verification result
+    ## are pickled under a hash of the contents of both files, so that
+    ## unchanged rules are neither parsed nor verified again.
+    ##
+    if cachedir is None:
+        a2ipa = alphabet2ipa(langrules, missing=missing, loglevel=loglevel)
+        allGood = a2ipa.check(check) if not check is None else True
+        return (a2ipa, allGood)
+
+    with langrules as source:
+        rulesText = source.read()
+    checkText = check.read() if not check is None else None
+
+    key = hashlib.sha256(repr((CACHE_VERSION, missing, rulesText, checkText)).encode("utf8")).hexdigest()
+    cachefile = os.path.join(cachedir, key + ".pickle")
+
+    if os.path.exists(cachefile):
+        try:
+            with open(cachefile, "rb") as cached:
+                (a2ipa, allGood) = pickle.load(cached)
+            a2ipa.loglevel = loglevel
+            if loglevel > 0:
+                print("Using cached rules from", cachefile, file=sys.stderr)
+
+            ##
+            ## Verify again to report the mismatches
+            ##
+            if not allGood:
+                a2ipa.check(io.StringIO(checkText))
+            return (a2ipa, allGood)
+        except Exception as ex:
+            print("Could not read cached rules ({}), rebuilding them".format(ex), file=sys.stderr)
+
+    a2ipa = alphabet2ipa(io.StringIO(rulesText), missing=missing, loglevel=loglevel)
+    allGood = a2ipa.check(io.StringIO(checkText)) if not checkText is None else True
+
+    ##
+    ## Write to a temporary file first, so concurrent runs never read a
+    ## partial cache
+    ##
+    os.makedirs(cachedir, exist_ok=True)
+    partial = "{}.{}.tmp".format(cachefile, os.getpid())
+    with open(partial, "wb") as cached:
+        pickle.dump((a2ipa, allGood), cached)
+    os.replace(partial, cachefile)
+
+    return (a2ipa, allGood)
+
+
+##
+## Rules of a worker process, set once when the worker starts
+##
+worker = None
+
+def startWorker(a2ipa):
+    global worker
+    worker = a2ipa
+
+
+def translateShard(words):
+    start = time.perf_counter()
+    pairs = [(word, " ".join(worker.translate(word))) for word in words]
+    return (os.getpid(), time.perf_counter() - start, pairs)
+
+
+def shards(words, size):
+    shard = []
+    for word in words:
+        shard.append(word)
+        if len(shard) == size:
+            yield shard
+            shard = []
+    if len(shard) > 0:
+        yield shard
+
+
+def translate_parallel(a2ipa, words, jobs, shardsize=2000):
+    ##
+    ## Translate words on a pool of processes, each with its own copy
+    ## of the rules. The word list is cut in shards, and (word,
+    ## translation) pairs come back in input order. Throughput of each
+    ## worker is reported when done.
+    ##
+    stats = defaultdict(lambda: [0, 0.0])
+    with Pool(jobs, initializer=startWorker, initargs=(a2ipa,)) as pool:
+        for (pid, elapsed, pairs) in pool.imap(translateShard, shards(words, shardsize)):
+            stats[pid][0] += len(pairs)
+            stats[pid][1] += elapsed
+            for pair in pairs:
+                yield pair
+
+    for (pid, (count, elapsed)) in sorted(stats.items()):
+        print("Worker {}: {} words in {:.2f}s ({:.0f} words/s)"
+              .format(pid, count, elapsed, count / elapsed if elapsed > 0 else inf)
+              , file=sys.stderr)
+
+
 def concatenate(*seqs):
     for seq in seqs:
         for item in seq:
@@ -303,6 +533,16 @@ def main(argv):
                         default=None, type=argparse.FileType('r', encoding="utf8"),
                         help="file to use for verification")
 
+    ##
+    ## Caches the compiled rules and verification result, keyed by the
+    ## contents of the rules and verification files
+    ##
+    parser.add_argument("-k", "--cache", dest="cache", action="store_true",
+                        help="cache compiled rules and verification results")
+    parser.add_argument("--cachedir", dest="cachedir",
+                        default=CACHE_DIR,
+                        help="directory for cached rules (default: {})".format(CACHE_DIR))
+
     ##
     ## Allows to read date from some file (which should not be compressed)
     ##
@@ -310,6 +550,13 @@ def main(argv):
                         default=None, type=argparse.FileType('r', encoding="utf8"),
                         help="file used for translation (read up to first space)")
 
+    ##
+    ## Number of processes used for translation
+    ##
+    parser.add_argument("-j", "--jobs", dest="jobs",
+                        default=1, type=int,
+                        help="number of processes to translate with")
+
     ##
     ## Any following words would be translated
     ##
@@ -317,14 +564,13 @@ def main(argv):
     
     options = vars(parser.parse_args(argv))
 
-    a2ipa = alphabet2ipa(options["langrules"], loglevel=options["loglevel"])
+    (a2ipa, allGood) = load(options["langrules"], options["check"], loglevel=options["loglevel"],
+                            cachedir=options["cachedir"] if options["cache"] else None)
     ##print(options)
 
-    if "check" in options and not options["check"] is None:
-        allGood = a2ipa.check(options["check"])
-        if not allGood:
-            print("Verification failed, not processing additional data", file=sys.stderr)
-            return []
+    if not allGood:
+        print("Verification failed, not processing additional data", file=sys.stderr)
+        return []
 
 
     if "read" in options and not options["read"] is None:
@@ -334,8 +580,11 @@ def main(argv):
             
     words = concatenate(options["words"], readwords)
     
-    ret = ((word, " ".join(a2ipa.translate(word)))
-           for  word in words)
+    if options["jobs"] > 1:
+        ret = translate_parallel(a2ipa, words, options["jobs"])
+    else:
+        ret = ((word, " ".join(a2ipa.translate(word)))
+               for  word in words)
 
     return ret
 